@@ -0,0 +1,145 @@
+#!/usr/bin/python3
+# Micro-benchmark for the per-frame processing of magni.py
+# Feeds synthetic frames through the colour modes, the inversion and the overlay
+# expiry check, using stand-ins for the picamera2 request and MappedArray, so it
+# runs on any Linux box with numpy and opencv, no camera needed
+import argparse
+import time
+import tracemalloc
+
+import numpy as np
+
+import magni
+
+# frame sizes (w, h) to test by default
+SIZES = [(640, 480), (1280, 720), (1920, 1080), (3840, 2160)]
+
+# stand-in for the buffers of a picamera2 request, holds one array per stream
+# and the metadata of the frame
+class FakeRequest:
+    def __init__(self, array, metadata=None):
+        self.array = array
+        self.metadata = metadata or {}
+
+    def get_metadata(self):
+        return self.metadata
+
+# stand-in for picamera2's MappedArray, gives direct access to the request buffer
+class FakeMappedArray:
+    def __init__(self, request, stream):
+        self.array = request.array
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        pass
+
+# stand-in for the camera, only the overlay is used per frame
+class FakeCamera:
+    def set_overlay(self, overlay):
+        pass
+
+# synthetic frame with text-like horizontal stripes and noise, in the layout
+# picamera2 uses for the given format
+def synthetic_frame(width, height, fmt):
+    rng = np.random.default_rng(0)
+    rows = np.arange(height).reshape(height, 1)
+    lines = np.where((rows // 12) % 3 == 0, 40, 220).astype(np.uint8)
+    gray = np.clip(lines + rng.integers(-30, 30, (height, width)), 0, 255).astype(np.uint8)
+    if fmt == 'YUV420':
+        chroma = np.full((height // 2, width), 128, dtype=np.uint8)
+        return np.concatenate([gray, chroma])
+    return np.dstack([gray, gray, gray])
+
+# set the state of color_mode as if the user had stepped to the given mode
+def select_mode(index, inverted):
+    magni.color_mode.index = index
+    magni.color_mode.is_inverted = inverted
+
+# all scenarios as (name, setup function)
+def scenarios():
+    for i, mode in enumerate(magni.COLOR_MODES):
+        if mode is None:
+            yield 'normal', lambda: select_mode(0, False)
+        else:
+            yield mode[0], lambda i=i: select_mode(i, False)
+    yield 'inverted', lambda: select_mode(0, True)
+
+    def active_overlay():
+        select_mode(0, False)
+        magni.ENABLE_OVERLAY = True
+        magni.overlay('1.50', 3600)
+    yield 'overlay active', active_overlay
+
+    def expiring_overlay():
+        select_mode(0, False)
+        magni.ENABLE_OVERLAY = True
+        magni.overlay('1.50', -1)
+    yield 'overlay expiry', expiring_overlay
+
+# percentile of sorted values, p in 0..100
+def percentile(values, p):
+    index = min(len(values) - 1, int(round(p / 100 * (len(values) - 1))))
+    return values[index]
+
+# run pre_callback on the frame and return per-frame durations in ms and the
+# peak of memory allocated per frame in bytes
+def measure(setup, request, frames, warmup):
+    setup()
+    for _ in range(warmup):
+        magni.pre_callback(request)
+
+    durations = []
+    for _ in range(frames):
+        setup()
+        start = time.perf_counter()
+        magni.pre_callback(request)
+        durations.append((time.perf_counter() - start) * 1000)
+
+    # separate pass for allocations, as tracing slows down the processing
+    allocated = []
+    tracemalloc.start()
+    for _ in range(min(frames, 10)):
+        setup()
+        current, peak = tracemalloc.get_traced_memory()
+        tracemalloc.reset_peak()
+        magni.pre_callback(request)
+        allocated.append(tracemalloc.get_traced_memory()[1] - current)
+    tracemalloc.stop()
+    magni.ENABLE_OVERLAY = False
+    return sorted(durations), max(allocated)
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the per-frame processing of magni.py')
+    parser.add_argument('--frames', type=int, default=50, help='measured frames per scenario')
+    parser.add_argument('--warmup', type=int, default=5, help='unmeasured frames before each scenario')
+    parser.add_argument('--format', choices=['BGR888', 'YUV420'], action='append',
+                        help='preview format(s) to test, default both')
+    parser.add_argument('--size', action='append', metavar='WxH', help='frame size(s) to test')
+    parser.add_argument('--workers', type=int, help='override FRAME_WORKERS')
+    args = parser.parse_args()
+
+    sizes = SIZES
+    if args.size:
+        sizes = [tuple(int(v) for v in size.split('x')) for size in args.size]
+    if args.workers is not None:
+        magni.FRAME_WORKERS = args.workers
+    magni.load_cv2()
+    magni.MappedArray = FakeMappedArray
+    magni.camera = FakeCamera()
+
+    print(f'{"format":8} {"size":>10} {"scenario":16} {"p50 ms":>8} {"p90 ms":>8} {"p99 ms":>8} {"max ms":>8} {"alloc/frame":>12}')
+    for fmt in args.format or ['BGR888', 'YUV420']:
+        magni.PREVIEW_FORMAT = fmt
+        for width, height in sizes:
+            request = FakeRequest(synthetic_frame(width, height, fmt))
+            for name, setup in scenarios():
+                durations, allocated = measure(setup, request, args.frames, args.warmup)
+                print(f'{fmt:8} {f"{width}x{height}":>10} {name:16} '
+                      f'{percentile(durations, 50):8.2f} {percentile(durations, 90):8.2f} '
+                      f'{percentile(durations, 99):8.2f} {durations[-1]:8.2f} '
+                      f'{allocated / 1024:9.1f} KiB', flush=True)
+
+if __name__ == '__main__':
+    main()
@@ -1,10 +1,22 @@
 #!/usr/bin/python3
 # Open camera preview, wait for button/key press event on raspi and react by
 # adapting camera parameters
+import time                    # for timeouts based on the monotonic clock
+startup_time = time.monotonic()
+
 import asyncio
+import collections             # for the readout and overlay caches
+import json                    # for writing telemetry
+import multiprocessing         # for the readout worker process
+from concurrent.futures import ThreadPoolExecutor  # for parallel frame processing
 from datetime import datetime
-import evdev                   # for input from mouse and command line
-from gpiozero import Button    # for external buttons
+
+# input libs are only available on the raspi, but are not needed to load this
+# module elsewhere, e.g. for benchmarks
+try:
+    import evdev                   # for input from mouse and command line
+except ImportError:
+    pass
 
 # load available camera lib (picamera on legacy, picamera2 on newer OS) 
 try:
@@ -19,20 +31,22 @@ try:
 except ImportError:
     pass
 
-# numpy and cv2 are only needed for the overlay text
+# numpy is needed for in-place frame processing, it's loaded by picamera2 anyway
+# cv2 for overlay text and colour modes is loaded later by load_cv2, as it is slow
 try:
-    import cv2
-    print("Using cv2")
     import numpy as np
     print("Using numpy")
 except ImportError:
     pass
 
 import os                      # for background OCR and TTS process
+import queue                   # for passing sentences between the readout threads
 import re                      # for parsing fbset output
+import shlex                   # for running the AUDIO command without a shell
 import signal                  # to kill background process 
 import subprocess              # for calling fbset to detect screen resolution and readout
 import sys                     # for checking if modules are loaded
+import threading               # for applying camera controls in the background
 
 # You can adapt this script to your specific setup, by changing the constants 
 # SCALE_FACTORS can be modified for a fixed set of scale factors
@@ -43,6 +57,37 @@ import sys                     # for checking if modules are loaded
 SCREEN_WIDTH = 1920
 SCREEN_HEIGHT = 1080
 
+# Show the camera preview as soon as possible on startup: opencv, the input
+# devices, the push buttons and the readout worker are loaded after the first
+# frame. The time of each startup phase is printed
+FAST_BOOT = True
+
+# Pixel format of the preview stream on picamera2
+# 'BGR888' converts each frame to gray for the colour modes
+# 'YUV420' works directly on the Y plane, which already is the grayscale image,
+# so colour modes and inversion need much less work per frame on slow models
+PREVIEW_FORMAT = 'BGR888'
+
+# Adapt the preview to the speed of the Pi: if processing a frame takes more than
+# QUALITY_BUDGET of the frame time, or frames get dropped, step down to the next
+# entry of QUALITY_LEVELS (smaller preview, lower frame rate or faster format).
+# Step up again after QUALITY_UP_S with less than half of the budget, waiting
+# twice as long each time a step up had to be undone. The level is stored per Pi
+# model and screen resolution in QUALITY_FILE and used on the next start
+# Overrides PREVIEW_FORMAT with the format of the level
+QUALITY_GOVERNOR = False
+QUALITY_LEVELS = [
+    # (preview size relative to the screen, frames per second, PREVIEW_FORMAT)
+    (1, 30, 'BGR888'),
+    (1, 30, 'YUV420'),
+    (1, 15, 'YUV420'),
+    (0.5, 30, 'YUV420'),
+    (0.5, 15, 'YUV420'),
+]
+QUALITY_BUDGET = 0.7
+QUALITY_UP_S = 30
+QUALITY_FILE = '/home/pi/.magni-quality.json'
+
 # Rotate view by 180 degrees for the typical use-case with camera behind object
 ROTATION = 180
 
@@ -64,6 +109,43 @@ SHARPNESS = 1
 # The default None will run autofocus on each change of magnification
 DISTANCE_TO_SURFACE_CM = None # replace with your distance, e.g. 24.5
 
+# Remember the lens position found by autofocus for each magnification, and
+# reuse it when coming back to the same magnification instead of a new autofocus
+# cycle. Only used if the image is still sharp with it (at least
+# FOCUS_SHARPNESS_RATIO of the sharpness right after the autofocus). Entries
+# expire after FOCUS_CACHE_TIMEOUT_S or when the camera view moves
+FOCUS_CACHE = True
+FOCUS_CACHE_TIMEOUT_S = 120
+FOCUS_SHARPNESS_RATIO = 0.7
+
+# The view counts as moved if the mean difference of gray values (0..255) to the
+# last still view is above MOTION_THRESHOLD. Changes within MOTION_SETTLE_S after
+# changing camera controls are ignored, as they are caused by the change itself
+MOTION_THRESHOLD = 12
+MOTION_SETTLE_S = 1
+
+# Zoom and move the view smoothly: on each frame it moves VIEW_STEP of the
+# remaining way to its new position, 1 jumps there at once
+# The arrow keys move the view by PAN_STEP of its size, holding them repeats.
+# With MOUSE_PAN moving the mouse moves the view, by MOUSE_PAN_SPEED screen
+# pixels per step of the mouse. It's off by default, as the mouse may be used
+# just for its buttons and shouldn't move the view when touched
+VIEW_STEP = 0.5
+PAN_STEP = 0.1
+MOUSE_PAN = False
+MOUSE_PAN_SPEED = 1
+
+# Steady a shaking view at high magnification (from STABILISE_MIN_FACTOR on): the
+# movement between frames is measured on a copy STABILISE_SIZE pixels wide and
+# the crop moves along with it. Movements beyond STABILISE_MAX_SHIFT of the view
+# size are taken as intended, and the view returns slowly to where it belongs
+# with STABILISE_DECAY per frame
+STABILISE = False
+STABILISE_MIN_FACTOR = 6
+STABILISE_SIZE = 128
+STABILISE_MAX_SHIFT = 0.2
+STABILISE_DECAY = 0.95
+
 # Pre-defined scale factors to cycle through with button/enter
 # These factors are camera pixels to screen pixels ratio, the actual
 # magnification depends also on the camera, the screen size and the distance
@@ -76,6 +158,58 @@ factor = SCALE_FACTORS[0]  # use first entry as initial factor on boot up
 OCR_LANG = 'eng'   # Tesseract's character recognition: eng, deu, spa, fra, ita
 TTS_LANG = 'en-GB' # Pico's Text to Speech: en-GB, en-US, de-DE, es-ES, fr-FR, it-IT
 
+# Run OCR and TTS in a worker process that is started once on boot, so the OCR
+# engine stays loaded (if tesserocr is installed) and frames are passed in memory
+# READOUT_TMP_DIR holds the synthesized speech, /dev/shm is in RAM
+READOUT_WORKER = True
+READOUT_TMP_DIR = '/dev/shm'
+
+# Start OCR in the background once the camera view has been still for
+# PREFETCH_STABLE_S, so readout can start speaking right away. It runs with lower
+# priority (PREFETCH_NICE, up to 19) and only for one image at a time
+PREFETCH = True
+PREFETCH_STABLE_S = 2
+PREFETCH_NICE = 10
+
+# Photos (key s) are saved as JPEG in PHOTO_DIR with PHOTO_QUALITY (0..100), while
+# the preview keeps running. Shift+s takes PHOTO_BURST photos, PHOTO_BURST_INTERVAL_S
+# apart. PHOTO_FULL_RESOLUTION takes them at the full resolution of the camera
+# sensor instead of the screen, without colour modes and with a short pause
+PHOTO_DIR = '/home/pi'
+PHOTO_QUALITY = 90
+PHOTO_BURST = 5
+PHOTO_BURST_INTERVAL_S = 0.5
+PHOTO_FULL_RESOLUTION = False
+
+# Capture the view for readout at the full resolution of the camera sensor instead
+# of the preview at screen size, so small print can be read at low magnification.
+# The preview pauses for a moment while the camera switches modes, so this is only
+# done while the crop is wider than the preview frame. The image is
+# binarised and straightened before OCR, turning by up to OCR_MAX_SKEW degrees
+READOUT_FULL_RESOLUTION = True
+OCR_MAX_SKEW = 10
+
+# The text is spoken sentence by sentence. A sentence ends at an empty line or at
+# punctuation followed by an uppercase letter, parts shorter than
+# MIN_SENTENCE_LENGTH characters (like "Dr." or "Exit.") are spoken with the next
+MIN_SENTENCE_LENGTH = 20
+
+# Keep the text of the last READOUT_CACHE_PAGES read pages and the speech of
+# their sentences in RAM, so reading the same page again starts instantly.
+# Speech is looked up by the exact sentence, up to READOUT_CACHE_BYTES of it.
+# Pages are looked up by a perceptual hash of the image with
+# READOUT_CACHE_HASH_SIZE^2 bits, of which up to READOUT_CACHE_MAX_DISTANCE may
+# differ, and are only reused if a copy READOUT_CACHE_THUMBNAIL_WIDTH pixels wide
+# has at most READOUT_CACHE_CHANGED_PIXELS pixels that differ by more than
+# READOUT_CACHE_PIXEL_DIFFERENCE gray values, so a changed digit is read again
+READOUT_CACHE_BYTES = 32 * 1024 * 1024
+READOUT_CACHE_PAGES = 16
+READOUT_CACHE_HASH_SIZE = 16
+READOUT_CACHE_MAX_DISTANCE = 8
+READOUT_CACHE_THUMBNAIL_WIDTH = 640
+READOUT_CACHE_PIXEL_DIFFERENCE = 64
+READOUT_CACHE_CHANGED_PIXELS = 4
+
 AUDIO = 'aplay'
 # uncomment next line to get audio via HDMI, see https://forums.raspberrypi.com/viewtopic.php?t=351718
 # AUDIO = 'aplay -D sysdefault:CARD=vc4hdmi'
@@ -102,12 +236,86 @@ COLOR_MODES = [
     ('Green on Black', GREEN, BLACK),
 ]
 
+# Number of threads for the colour modes and inversion, None uses all CPU cores
+# Frames with less pixels than FRAME_WORKERS_MIN_PIXELS are processed on one thread
+FRAME_WORKERS = None
+FRAME_WORKERS_MIN_PIXELS = 640 * 480
+
 # Enable overlay text for debugging
+# The overlay has 4 lines (slots), texts are rendered once and the last
+# OVERLAY_CACHE_SIZE of them are kept. Frames take no extra time while no text
+# is shown, and a moment only when a text expires
 ENABLE_OVERLAY = False
 OVERLAY_DURATION_S = 3
+OVERLAY_CACHE_SIZE = 32
+
+# Measure the performance of the camera pipeline, e.g. to choose the Pi model and
+# resolution: time spent in pre_callback, interval between frames and dropped
+# frames, and latency from a key press to the first frame with the new
+# magnification. Statistics of the last TELEMETRY_WINDOW frames are written to
+# TELEMETRY_FILE as JSON every TELEMETRY_INTERVAL_S, and shown in the last two
+# overlay lines if ENABLE_OVERLAY is set
+TELEMETRY = False
+TELEMETRY_WINDOW = 300
+TELEMETRY_INTERVAL_S = 5
+TELEMETRY_FILE = '/dev/shm/magni-telemetry.json'
+# upper bounds in ms of the histogram buckets, the last one takes everything above
+TELEMETRY_BUCKETS_MS = [1, 2, 5, 10, 20, 35, 50, 100, 200, 500, 1000]
 
 # Readout uses a background process to run OCR and TTS
 bg_process = None
+first_frame = threading.Event()  # set by pre_callback, for the startup
+
+# load opencv, if it's installed
+def load_cv2():
+    global cv2
+    if 'cv2' in globals():
+        return
+    try:
+        import cv2
+        print("Using cv2")
+        if getattr(frame_workers, 'pool', None) is not None:
+            # avoid opencv starting its own threads inside each stripe
+            cv2.setNumThreads(1)
+    except ImportError:
+        pass
+
+# record the end of a startup phase, with the time it took since the last one
+def startup_phase(name):
+    now = time.monotonic()
+    if not hasattr(startup_phase, 'phases'):
+        startup_phase.phases = []
+        startup_phase.last = startup_time
+    startup_phase.phases.append((name, now - startup_phase.last))
+    startup_phase.last = now
+
+# print the startup phases, starting with python itself until magni was loaded
+def print_startup():
+    phases = list(startup_phase.phases)
+    try:
+        with open('/proc/self/stat') as f:
+            start_ticks = int(f.read().rsplit(')', 1)[1].split()[19])
+        process_s = time.clock_gettime(time.CLOCK_BOOTTIME) - start_ticks / os.sysconf('SC_CLK_TCK')
+        phases.insert(0, ('python', process_s - (time.monotonic() - startup_time)))
+    except (OSError, ValueError, IndexError, AttributeError):
+        pass
+    total = sum(duration for name, duration in phases)
+    print(f'Startup took {total:.2f} s:', ', '.join(f'{name} {duration:.2f} s' for name, duration in phases))
+
+# screen resolution from the framebuffer in sysfs, which is quicker than starting
+# fbset, e.g. 'U:1920x1080p-0' in modes
+def screen_resolution():
+    try:
+        with open('/sys/class/graphics/fb0/modes') as f:
+            m = re.search('([0-9]+)x([0-9]+)', f.read())
+        if m:
+            width = int(m.group(1))
+            height = int(m.group(2))
+            print('Framebuffer screen resolution (w, h): ', width, height)
+            return width, height
+    except OSError:
+        pass
+    return screen_resolution_fbset()
 
 # fbset is supported on new and legacy OS
 # shows actual framebuffer resolution instead of physical screen size
@@ -128,67 +336,486 @@ def screen_resolution_fbset():
         pass
     return SCREEN_WIDTH, SCREEN_HEIGHT
 
-# show text on screen for a duration given in seconds
-def overlay(text, duration_s = OVERLAY_DURATION_S):
+# show text on screen for a duration given in seconds, 0 shows it until replaced
+# each slot (0..3) is a line of the overlay, an empty text clears the slot
+def overlay(text, duration_s = OVERLAY_DURATION_S, slot = 0):
+    if ENABLE_OVERLAY and 'numpy' in sys.modules and 'cv2' in globals():
+        if not hasattr(overlay, 'slots'):
+            overlay.slots = {}
+            overlay.lock = threading.Lock()
+        with overlay.lock:
+            if len(text) == 0:
+                overlay.slots.pop(slot, None)
+            else:
+                ts_end = time.monotonic() + duration_s if duration_s != 0 else None
+                overlay.slots[slot] = (text, ts_end)
+            show_overlay()
+
+# set the overlay to the texts of all slots and remember when the next one expires
+# needs overlay.lock
+def show_overlay():
     global camera
+    ends = [ts_end for text, ts_end in overlay.slots.values() if ts_end is not None]
+    overlay.expiry = min(ends) if ends else None
+    if len(overlay.slots) == 0:
+        camera.set_overlay(None)
+        return
+    buffer = np.zeros((200, 400, 4), dtype=np.uint8)
+    for slot, (text, ts_end) in overlay.slots.items():
+        buffer[slot * 50:(slot + 1) * 50] = overlay_sprite(text)
+    camera.set_overlay(buffer)
+
+# remove the texts whose display duration is over, called once overlay.expiry passed
+def expire_overlay():
+    with overlay.lock:
+        ts_now = time.monotonic()
+        for slot, (text, ts_end) in list(overlay.slots.items()):
+            if ts_end is not None and ts_end <= ts_now:
+                del overlay.slots[slot]
+        show_overlay()
 
-    if ENABLE_OVERLAY and 'numpy' in sys.modules and 'cv2' in sys.modules:
+# line of overlay text, rendered on first use and kept in a LRU cache
+def overlay_sprite(text):
+    if not hasattr(overlay_sprite, 'cache'):
+        overlay_sprite.cache = collections.OrderedDict()
+    sprite = overlay_sprite.cache.pop(text, None)
+    if sprite is None:
         colour = (255, 0, 0, 255)
-        origin = (0, 50)
+        origin = (0, 40)
         font = cv2.FONT_HERSHEY_SIMPLEX
         scale = 1
         thickness = 2
-        buffer = np.zeros((200, 400, 4), dtype=np.uint8)
-        cv2.putText(buffer, text, origin, font, scale, colour, thickness)
-        camera.set_overlay(buffer)
-
-        if duration_s == 0:
-            overlay.content = None
-        else:
-            ts_now = datetime.timestamp(datetime.now())
-            ts_end = ts_now + duration_s
-            overlay.content = (text, ts_end)
+        sprite = np.zeros((50, 400, 4), dtype=np.uint8)
+        cv2.putText(sprite, text, origin, font, scale, colour, thickness)
+        if len(overlay_sprite.cache) >= OVERLAY_CACHE_SIZE:
+            overlay_sprite.cache.popitem(last=False)
+    overlay_sprite.cache[text] = sprite
+    return sprite
 
 # Create a colormap / palette as gradient from one color to another
 # The colors are given as 8 bit RGB tuple
 def colormap(color1, color2):
-    palette = np.zeros((256, 1, 3), dtype=np.uint8)
-    for i in range(256):
-        palette[i, 0, 0] = int(color1[0] + i * (color2[0] - color1[0]) / 255)
-        palette[i, 0, 1] = int(color1[1] + i * (color2[1] - color1[1]) / 255)
-        palette[i, 0, 2] = int(color1[2] + i * (color2[2] - color1[2]) / 255)
-    return palette
+    start = np.array(color1, dtype=np.float64)
+    end = np.array(color2, dtype=np.float64)
+    steps = np.arange(256, dtype=np.float64).reshape(256, 1)
+    palette = start + steps * (end - start) / 255
+    return palette.astype(np.uint8).reshape(256, 1, 3)
+
+# palette for the given entry in COLOR_MODES, only computed on first use
+def color_palette(index):
+    if not hasattr(color_palette, 'cache'):
+        color_palette.cache = {}
+    if index not in color_palette.cache:
+        name, dark, light = COLOR_MODES[index]
+        color_palette.cache[index] = colormap(dark, light)
+    return color_palette.cache[index]
+
+# scratch buffers for the per-frame processing, allocated once for the preview
+# size and only reallocated when the frame size changes
+def frame_buffer(name, shape):
+    if not hasattr(frame_buffer, 'buffers'):
+        frame_buffer.buffers = {}
+    buffer = frame_buffer.buffers.get(name)
+    if buffer is None or buffer.shape != shape:
+        buffer = np.empty(shape, dtype=np.uint8)
+        frame_buffer.buffers[name] = buffer
+        print('Allocated frame buffer', name, shape)
+    return buffer
+
+# thread pool for processing stripes of a frame in parallel
+# numpy and opencv release the GIL, so this spreads the work over all cores
+def frame_workers():
+    if not hasattr(frame_workers, 'pool'):
+        frame_workers.count = FRAME_WORKERS or os.cpu_count() or 1
+        frame_workers.pool = None
+        if frame_workers.count > 1:
+            frame_workers.pool = ThreadPoolExecutor(frame_workers.count, thread_name_prefix='frame')
+            if 'cv2' in globals():
+                # avoid opencv starting its own threads inside each stripe
+                cv2.setNumThreads(1)
+    return frame_workers.pool
+
+# call function(start, end) for horizontal stripes covering all rows of a frame
+# start and end of each stripe are multiples of align, except for the last end
+def run_striped(function, rows, pixels, align=1):
+    pool = frame_workers()
+    if pool is None or pixels < FRAME_WORKERS_MIN_PIXELS:
+        function(0, rows)
+        return
+    step = -(-rows // frame_workers.count)
+    step += -step % align
+    jobs = [pool.submit(function, start, min(start + step, rows)) for start in range(0, rows, step)]
+    for job in jobs:
+        job.result()
+
+# invert all rows of a frame, in YUV420 this inverts luminance and chroma
+def invert_frame(array):
+    def stripe(start, end):
+        np.invert(array[start:end], out=array[start:end])
+    run_striped(stripe, array.shape[0], array.shape[0] * array.shape[1])
+
+# apply a colour mode to a BGR888 frame via its gray image
+def bgr_color_mode(array, index):
+    palette = color_palette(index)
+    buffer = frame_buffer('gray', array.shape[:2])
+    def stripe(start, end):
+        cv2.cvtColor(array[start:end], cv2.COLOR_BGR2GRAY, dst=buffer[start:end])
+        # look up the gray values in the palette and write straight into the frame
+        cv2.applyColorMap(buffer[start:end], palette, dst=array[start:end])
+    run_striped(stripe, buffer.shape[0], buffer.size)
+
+# YUV420 frames hold the full size Y plane followed by the U and V planes at
+# half width and height, picamera2 maps all of them as one (h * 3/2, stride) array
+def yuv_planes(array):
+    stride = array.shape[1]
+    height = array.shape[0] * 2 // 3
+    flat = array.reshape(-1)
+    y_size = height * stride
+    uv_size = (height // 2) * (stride // 2)
+    y = flat[:y_size].reshape(height, stride)
+    u = flat[y_size:y_size + uv_size].reshape(height // 2, stride // 2)
+    v = flat[y_size + uv_size:y_size + 2 * uv_size].reshape(height // 2, stride // 2)
+    return y, u, v
+
+# lookup tables from gray to Y, U and V of the palette for the given COLOR_MODES entry
+def yuv_palette(index):
+    if not hasattr(yuv_palette, 'cache'):
+        yuv_palette.cache = {}
+    if index not in yuv_palette.cache:
+        # picamera2 uses full range BT.601 (sYCC) for YUV preview streams
+        ycrcb = cv2.cvtColor(color_palette(index), cv2.COLOR_RGB2YCrCb)
+        yuv_palette.cache[index] = tuple(np.ascontiguousarray(ycrcb[:, 0, c]) for c in (0, 2, 1))
+    return yuv_palette.cache[index]
+
+# apply a colour mode to a YUV420 frame, using the Y plane as gray input
+def yuv_color_mode(array, index):
+    lut_y, lut_u, lut_v = yuv_palette(index)
+    y, u, v = yuv_planes(array)
+    half = frame_buffer('half', u.shape)
+    def stripe(start, end):
+        # chroma planes have half the size, so map them from a downscaled Y plane
+        half_start, half_end = start // 2, end // 2
+        cv2.resize(y[start:end], (u.shape[1], half_end - half_start),
+                   dst=half[half_start:half_end], interpolation=cv2.INTER_NEAREST)
+        cv2.LUT(half[half_start:half_end], lut_u, dst=u[half_start:half_end])
+        cv2.LUT(half[half_start:half_end], lut_v, dst=v[half_start:half_end])
+        cv2.LUT(y[start:end], lut_y, dst=y[start:end])
+    # stripes start on even rows to match the chroma rows
+    run_striped(stripe, y.shape[0], y.size, align=2)
 
 # called on each frame with picamera2 to modify the colors
+# works in place on the frame and the preallocated buffers to avoid allocations
 def color_mode_callback(request):
     # picamera2 doesn't support image_effect, need to invert manually instead
     if hasattr(color_mode, 'is_inverted') and color_mode.is_inverted:
         with MappedArray(request, "main") as m:
-            m.array[...] = ~m.array
+            invert_frame(m.array)
     elif hasattr(color_mode, 'index') and COLOR_MODES[color_mode.index] != None:
-        name, dark, light = COLOR_MODES[color_mode.index]
         with MappedArray(request, "main") as m:
-            buffer = cv2.cvtColor(m.array, cv2.COLOR_BGR2GRAY)
-            heatmap = cv2.applyColorMap(buffer, colormap(dark, light))
-            m.array[...] = heatmap
+            if PREVIEW_FORMAT == 'YUV420':
+                yuv_color_mode(m.array, color_mode.index)
+            else:
+                bgr_color_mode(m.array, color_mode.index)
+
+# gray image of a frame, the Y plane in YUV420 and the green channel in BGR888
+def frame_gray(array):
+    if PREVIEW_FORMAT == 'YUV420':
+        return yuv_planes(array)[0]
+    return array[:, :, 1]
+
+# called on frames with picamera2 to detect if the camera view moved
+# compares a small thumbnail of the frame with the one of the last still view
+def motion_callback(request):
+    now = time.monotonic()
+    if now < getattr(motion_callback, 'ignore_until', 0):
+        return
+    with MappedArray(request, "main") as m:
+        gray = frame_gray(m.array)
+        step = max(1, gray.shape[1] // 80)
+        thumbnail = gray[::step, ::step].astype(np.int16)
+    reference = getattr(motion_callback, 'reference', None)
+    if reference is None or reference.shape != thumbnail.shape:
+        motion_callback.reference = thumbnail
+    elif np.abs(thumbnail - reference).mean() > MOTION_THRESHOLD:
+        motion_callback.reference = thumbnail
+        motion_callback.last_motion = now
+
+# ignore changes of the view for a while, e.g. when zooming or changing brightness
+def settle_motion():
+    motion_callback.reference = None
+    motion_callback.ignore_until = time.monotonic() + MOTION_SETTLE_S
+
+# called on a frame with picamera2 when measure_sharpness requested it
+# uses the mean gradient of the gray image at half resolution
+def sharpness_callback(request):
+    with MappedArray(request, "main") as m:
+        small = frame_gray(m.array)[::2, ::2].astype(np.float32)
+    sharpness_callback.result = float(np.abs(np.diff(small, axis=0)).mean() + np.abs(np.diff(small, axis=1)).mean())
+    sharpness_callback.requested = False
+    sharpness_callback.done.set()
+
+# sharpness of the next frame, or None if no frame arrived within timeout_s
+def measure_sharpness(timeout_s = 1):
+    sharpness_callback.result = None
+    sharpness_callback.done = threading.Event()
+    sharpness_callback.requested = True
+    sharpness_callback.done.wait(timeout_s)
+    return sharpness_callback.result
 
 # called on each frame by picamera2 for modifications like color modes
 def pre_callback(request):
+    if not first_frame.is_set():
+        first_frame.set()
+    if TELEMETRY or QUALITY_GOVERNOR:
+        started = time.perf_counter()
+        process_frame(request)
+        duration_s = time.perf_counter() - started
+        if TELEMETRY:
+            record_frame(request, duration_s)
+        if QUALITY_GOVERNOR:
+            govern_frame(request, duration_s)
+    else:
+        process_frame(request)
+
+# all modifications of a frame, see pre_callback
+def process_frame(request):
+    if getattr(capture_full_resolution, 'active', False):
+        # full resolution captures for readout and photos are left as they are
+        return
+    stabilise_callback(request)
+    viewport_callback(request)
+    prefetching = PREFETCH and hasattr(readout, 'worker')
+    if prefetching or (FOCUS_CACHE and getattr(focus_window, 'cache', None)):
+        motion_callback(request)
+    if getattr(sharpness_callback, 'requested', False):
+        sharpness_callback(request)
+    if prefetching:
+        # before the colour modes, OCR works best on the original image
+        prefetch_callback(request)
     color_mode_callback(request)
 
-    if ENABLE_OVERLAY and hasattr(overlay, 'content') and overlay.content != None:
-        # remove overlay text if display duration is over
-        text, ts_end = overlay.content
-        ts_now = datetime.timestamp(datetime.now())
-        if ts_now > ts_end:
-            overlay('', 0)
+    expiry = getattr(overlay, 'expiry', None)
+    if expiry is not None and time.monotonic() > expiry:
+        expire_overlay()
+
+# state of the telemetry, with a rolling window of samples per measurement in ms
+def telemetry():
+    if not hasattr(telemetry, 'lock'):
+        telemetry.lock = threading.Lock()
+        telemetry.samples = {name: collections.deque(maxlen=TELEMETRY_WINDOW)
+                             for name in ('callback_ms', 'interval_ms', 'latency_ms')}
+        telemetry.frames = 0
+        telemetry.dropped = 0
+        telemetry.sensor_time = None
+        telemetry.input_time = None
+        telemetry.expected_crop = None
+    return telemetry
+
+# measure a frame after pre_callback processed it in duration_s
+def record_frame(request, duration_s):
+    state = telemetry()
+    metadata = request.get_metadata()
+    now = time.monotonic()
+    with state.lock:
+        state.frames += 1
+        state.samples['callback_ms'].append(duration_s * 1000)
+        sensor_time = metadata.get('SensorTimestamp')
+        if sensor_time is not None and state.sensor_time is not None:
+            interval_ms = (sensor_time - state.sensor_time) / 1000000
+            state.samples['interval_ms'].append(interval_ms)
+            frame_duration = metadata.get('FrameDuration')
+            if frame_duration:
+                # a gap of several frame durations means frames were dropped
+                state.dropped += max(0, round(interval_ms * 1000 / frame_duration) - 1)
+        state.sensor_time = sensor_time
+
+        crop = metadata.get('ScalerCrop')
+        if state.expected_crop is not None and crop is not None:
+            window, input_time = state.expected_crop
+            # the camera may round the crop to its alignment
+            if max(abs(a - b) for a, b in zip(crop, window)) <= 16:
+                state.samples['latency_ms'].append((now - input_time) * 1000)
+                state.expected_crop = None
+
+# remember the time of an input event, in the monotonic clock like the frames
+# evdev uses the wall clock, events older than a second (e.g. replayed ones)
+# count as new
+def record_input(event):
+    state = telemetry()
+    age = time.time() - event.timestamp()
+    state.input_time = time.monotonic() - (age if 0 <= age < 1 else 0)
+
+# the next frames should show this ScalerCrop, caused by the last input event
+# unless that was more than a second ago, then the view moved for another reason
+def expect_crop(window):
+    state = telemetry()
+    with state.lock:
+        input_time, state.input_time = state.input_time, None
+        if input_time is not None and time.monotonic() - input_time < 1:
+            state.expected_crop = (window, input_time)
+
+# percentiles and histogram of samples in ms
+def telemetry_summary(samples):
+    values = sorted(samples)
+    if len(values) == 0:
+        return None
+    pick = lambda p: values[min(len(values) - 1, int(round(p / 100 * (len(values) - 1))))]
+    histogram = [0] * (len(TELEMETRY_BUCKETS_MS) + 1)
+    bucket = 0
+    for value in values:
+        while bucket < len(TELEMETRY_BUCKETS_MS) and value > TELEMETRY_BUCKETS_MS[bucket]:
+            bucket += 1
+        histogram[bucket] += 1
+    return {'p50': pick(50), 'p90': pick(90), 'p99': pick(99), 'max': values[-1],
+            'buckets_ms': TELEMETRY_BUCKETS_MS, 'histogram': histogram}
+
+# current telemetry as dict, for TELEMETRY_FILE
+def telemetry_report():
+    state = telemetry()
+    with state.lock:
+        samples = {name: list(values) for name, values in state.samples.items()}
+        report = {'time': time.time(), 'frames': state.frames, 'dropped_frames': state.dropped}
+    if hasattr(camera, 'camera_config'):
+        report['size'] = list(camera.camera_config['main']['size'])
+        report['format'] = camera.camera_config['main']['format']
+    for name, values in samples.items():
+        report[name] = telemetry_summary(values)
+    return report
+
+# write the telemetry every TELEMETRY_INTERVAL_S and show it in the overlay
+def telemetry_thread():
+    while True:
+        time.sleep(TELEMETRY_INTERVAL_S)
+        try:
+            report = telemetry_report()
+            # replace the file at once, so readers never see half of it
+            with open(TELEMETRY_FILE + '.tmp', 'w') as f:
+                json.dump(report, f)
+            os.replace(TELEMETRY_FILE + '.tmp', TELEMETRY_FILE)
+
+            callback, interval, latency = (report[name] for name in ('callback_ms', 'interval_ms', 'latency_ms'))
+            if callback is not None and interval is not None and interval['p50'] > 0:
+                overlay(f'{callback["p90"]:.1f}ms {1000 / interval["p50"]:.0f}fps {report["dropped_frames"]}drop',
+                        0, slot=2)
+            if latency is not None:
+                overlay(f'input {latency["p50"]:.0f}/{latency["max"]:.0f}ms', 0, slot=3)
+        except Exception as e:
+            print('Failed to write telemetry:', e)
+
+# preview size, format and controls of a level in QUALITY_LEVELS
+def quality_config(level, width, height):
+    relative_size, fps, fmt = QUALITY_LEVELS[level]
+    size = (int(width * relative_size) // 2 * 2, int(height * relative_size) // 2 * 2)
+    frame_us = int(1000000 / fps)
+    return size, fmt, {'FrameDurationLimits': (frame_us, frame_us)}
+
+# key of this Pi model and screen resolution in QUALITY_FILE
+def quality_key(width, height):
+    try:
+        with open('/proc/device-tree/model') as f:
+            model = f.read().strip('\0\n ')
+    except OSError:
+        model = 'unknown'
+    return f'{model} {width}x{height}'
+
+# quality levels stored in QUALITY_FILE
+def quality_levels():
+    try:
+        with open(QUALITY_FILE) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+# called on each frame when QUALITY_GOVERNOR is set, checks the frames of each
+# second against the budget of the current level and changes the level if needed
+def govern_frame(request, duration_s):
+    state = govern_frame
+    now = time.monotonic()
+    if getattr(state, 'changing', False) or getattr(capture_full_resolution, 'active', False):
+        # the first frames after a mode switch don't tell about the load
+        state.window_start = None
+        return
+    if getattr(state, 'window_start', None) is None:
+        state.window_start = now
+        state.durations = []
+        state.dropped = 0
+        state.sensor_time = None
+        state.relaxed_since = getattr(state, 'relaxed_since', now)
+    state.durations.append(duration_s)
+    metadata = request.get_metadata()
+    sensor_time, frame_duration = metadata.get('SensorTimestamp'), metadata.get('FrameDuration')
+    if sensor_time is not None and state.sensor_time is not None and frame_duration:
+        # a gap of several frame durations means frames were dropped
+        state.dropped += max(0, round((sensor_time - state.sensor_time) / 1000 / frame_duration) - 1)
+    state.sensor_time = sensor_time
+    if now - state.window_start < 1:
+        return
+
+    level = getattr(state, 'level', 0)
+    budget_s = QUALITY_BUDGET / QUALITY_LEVELS[level][1]
+    durations = sorted(state.durations)
+    p90 = durations[int(0.9 * (len(durations) - 1))]
+    overloaded = p90 > budget_s or state.dropped > len(durations) // 10
+    relaxed = p90 < budget_s / 2 and state.dropped == 0
+    state.window_start = None
+    if not hasattr(state, 'up_s'):
+        state.up_s = {}
+
+    if overloaded and level < len(QUALITY_LEVELS) - 1:
+        if now - getattr(state, 'stepped_up', 0) < state.up_s.get(level, QUALITY_UP_S):
+            # the last step up was too much, wait longer before trying again
+            state.up_s[level] = 2 * state.up_s.get(level, QUALITY_UP_S)
+        change_quality(level + 1)
+    elif not relaxed:
+        state.relaxed_since = now
+    elif level > 0 and now - state.relaxed_since >= state.up_s.get(level - 1, QUALITY_UP_S):
+        state.stepped_up = now
+        change_quality(level - 1)
+
+# switch to another level of QUALITY_LEVELS in the control thread
+def change_quality(level):
+    govern_frame.changing = True
+    schedule_controls({}, task=lambda: apply_quality(level))
+
+# reconfigure the preview for a level of QUALITY_LEVELS, the DRM preview keeps
+# its size on screen and scales the frames, and store the level for the next start
+# runs in the control thread
+def apply_quality(level):
+    global PREVIEW_FORMAT
+    try:
+        width, height = screen
+        size, fmt, frame_controls = quality_config(level, width, height)
+        config = camera.create_preview_configuration(
+            main={'size': size, 'format': fmt},
+            transform=camera.camera_config['transform'],
+            controls={**current_controls(), **frame_controls})
+        camera.stop()
+        camera.configure(config)
+        PREVIEW_FORMAT = fmt
+        allocate_frame_buffers(camera)
+        camera.start()
+        govern_frame.level = level
+        print('Quality level', level, QUALITY_LEVELS[level])
+
+        levels = quality_levels()
+        levels[quality_key(width, height)] = level
+        with open(QUALITY_FILE, 'w') as f:
+            json.dump(levels, f)
+    except Exception as e:
+        print('Failed to change quality level:', e)
+    finally:
+        govern_frame.relaxed_since = time.monotonic()
+        govern_frame.changing = False
 
 def color_mode():
     global camera
     if hasattr(camera, 'image_effect'):
         # in legacy picamera toggle between normal and inverted colours
         camera.image_effect = 'none' if camera.image_effect == 'negative' else 'negative'
-    elif 'numpy' in sys.modules and 'cv2' in sys.modules:
+        return
+    # opencv may not be loaded yet right after startup
+    load_cv2()
+    if 'numpy' in sys.modules and 'cv2' in globals():
         # if opencv is installed with picamera2, step through predefined color modes
         if not hasattr(color_mode, 'index'):
             color_mode.index = 0
@@ -199,6 +826,131 @@ def color_mode():
             color_mode.is_inverted = False
         color_mode.is_inverted = not color_mode.is_inverted
 
+# Camera controls are applied in a background thread, so slow calls like the
+# autofocus don't block the input handling. Changes that pile up while the camera
+# is busy are merged, so only the latest value of each control gets applied.
+# autofocus(generation) is called after applying the controls and cancels a
+# running autofocus, see run_autofocus. Tasks are called in the background thread
+# after the controls, each of them in the order they were scheduled
+def schedule_controls(new_controls, autofocus=None, task=None, cancel_autofocus=False):
+    if not hasattr(control_thread, 'condition'):
+        control_thread.condition = threading.Condition()
+        control_thread.controls = {}
+        control_thread.autofocus = None
+        control_thread.tasks = collections.deque()
+        control_thread.generation = 0
+        threading.Thread(target=control_thread, name='controls', daemon=True).start()
+
+    with control_thread.condition:
+        control_thread.controls.update(new_controls)
+        if autofocus is not None or cancel_autofocus:
+            # stops a running autofocus cycle
+            control_thread.generation += 1
+            control_thread.autofocus = autofocus
+        if task is not None:
+            control_thread.tasks.append(task)
+        control_thread.condition.notify()
+    # tasks alone, like a capture for readout, leave the view as it is and
+    # mustn't make the prefetched text look outdated
+    if new_controls or autofocus is not None or cancel_autofocus:
+        settle_motion()
+
+# background thread applying the controls given to schedule_controls
+def control_thread():
+    while True:
+        with control_thread.condition:
+            while not (control_thread.controls or control_thread.autofocus or control_thread.tasks):
+                control_thread.condition.wait()
+            new_controls, control_thread.controls = control_thread.controls, {}
+            autofocus, control_thread.autofocus = control_thread.autofocus, None
+            tasks = list(control_thread.tasks)
+            control_thread.tasks.clear()
+            generation = control_thread.generation
+
+        try:
+            if new_controls:
+                camera.set_controls(new_controls)
+        except Exception as e:
+            print('Failed to apply camera controls:', e)
+        for task in tasks:
+            try:
+                task()
+            except Exception as e:
+                print('Failed to run camera task:', e)
+        try:
+            if autofocus is not None:
+                autofocus(generation)
+        except Exception as e:
+            print('Failed to apply camera controls:', e)
+
+# apply controls scheduled while the control thread waits for frames in a long
+# call like run_autofocus, so e.g. a brightness change doesn't wait for the focus
+def apply_pending_controls():
+    with control_thread.condition:
+        new_controls, control_thread.controls = control_thread.controls, {}
+    if new_controls:
+        camera.set_controls(new_controls)
+
+# run an autofocus cycle with the given controls, e.g. the AfWindows to focus on
+# stops early if a newer request supersedes it
+# returns True if focused, False if focus failed and None if cancelled
+def run_autofocus(af_controls, generation):
+    camera.set_controls({**af_controls, 'AfMode': controls.AfModeEnum.Auto,
+                         'AfTrigger': controls.AfTriggerEnum.Start})
+    scanning = False
+    # give up after about 3 s, and if the cycle doesn't start within 10 frames
+    for frame in range(100):
+        if control_thread.generation != generation:
+            camera.set_controls({'AfTrigger': controls.AfTriggerEnum.Cancel})
+            return None
+        apply_pending_controls()
+        metadata = camera.capture_metadata()
+        state = metadata.get('AfState')
+        if state == controls.AfStateEnum.Scanning:
+            scanning = True
+        elif scanning or frame >= 10:
+            focus.val = metadata.get('LensPosition', getattr(focus, 'val', None))
+            return state == controls.AfStateEnum.Focused
+    camera.set_controls({'AfTrigger': controls.AfTriggerEnum.Cancel})
+    return False
+
+# focus on the crop window of a magnification, reusing the lens position from the
+# last autofocus on a window of the same size if the image is still sharp enough
+# with it, otherwise (or if the cached position expired) run an autofocus cycle
+def focus_window(window, generation):
+    if not hasattr(focus_window, 'cache'):
+        focus_window.cache = {}
+    af_controls = {'AfMetering': controls.AfMeteringEnum.Windows, 'AfWindows': [window]}
+    if not FOCUS_CACHE:
+        return run_autofocus(af_controls, generation)
+
+    # the magnification matters, not where the view was moved to
+    size = window[2:]
+    entry = focus_window.cache.pop(size, None)
+    now = time.monotonic()
+    if entry is not None and now - entry['time'] < FOCUS_CACHE_TIMEOUT_S \
+            and entry['time'] > getattr(motion_callback, 'last_motion', 0):
+        camera.set_controls({'AfMode': controls.AfModeEnum.Manual, 'LensPosition': entry['lens']})
+        focus.val = entry['lens']
+        # wait till the lens got there, a few frames at most
+        for _ in range(10):
+            if control_thread.generation != generation:
+                return None
+            apply_pending_controls()
+            if abs(camera.capture_metadata()['LensPosition'] - entry['lens']) < 0.05:
+                break
+        sharpness = measure_sharpness()
+        if sharpness is not None and sharpness >= FOCUS_SHARPNESS_RATIO * entry['sharpness']:
+            focus_window.cache[size] = entry
+            return True
+
+    result = run_autofocus(af_controls, generation)
+    if result:
+        sharpness = measure_sharpness()
+        if sharpness is not None:
+            focus_window.cache[size] = {'lens': focus.val, 'sharpness': sharpness, 'time': time.monotonic()}
+    return result
+
 # react on button pressed
 def next_factor():
     global factor
@@ -219,7 +971,7 @@ def next_factor():
     
     
 # change to given scale factor
-# always start in top left corner to maintain the same reading position
+# keeps the top left corner of the view to maintain the same reading position
 def scale(new_factor):
     global camera
     global factor
@@ -243,15 +995,132 @@ def scale(new_factor):
     crop_w = int(camera_w / factor)
     crop_h = min(int(crop_w / screen_ratio), camera_h)
 
-    window = (x, y, crop_w, crop_h)
-    camera.set_controls({'ScalerCrop': window})
+    if hasattr(scale, 'window'):
+        x, y = scale.window[:2]
+    window = view_window(x, y, crop_w, crop_h)
+    # viewport_callback zooms there on the next frames
+    scale.window = window
     overlay(f'{factor:.2f}')
     
     # focus on cropped area if camera supports autofocus
     if 'AfMode' in camera.camera_controls and DISTANCE_TO_SURFACE_CM is None:
-        camera.set_controls({'AfMode': controls.AfModeEnum.Auto, 'AfMetering': controls.AfMeteringEnum.Windows})
-        camera.set_controls({'AfWindows': [window]})
-        camera.autofocus_cycle()
+        schedule_controls({}, autofocus=lambda generation: focus_window(sensor_window(window), generation))
+
+# crop window at the given position, moved inside the sensor area if needed
+# the position stays fractional, so many small pan steps add up
+def view_window(x, y, width, height):
+    min_x, min_y, camera_w, camera_h = camera.camera_properties['ScalerCropMaximum']
+    x = min(max(x, min_x), min_x + camera_w - width)
+    y = min(max(y, min_y), min_y + camera_h - height)
+    return (x, y, width, height)
+
+# a crop window in whole sensor pixels, as the camera controls take it
+def sensor_window(window):
+    return tuple(int(round(v)) for v in window)
+
+# move the view by the given fraction of its size, e.g. -0.1 for a tenth to the left
+def pan(fraction_x, fraction_y):
+    if not hasattr(scale, 'window'):
+        return
+    x, y, width, height = scale.window
+    scale.window = view_window(x + fraction_x * width, y + fraction_y * height, width, height)
+
+# move the view along with the mouse, by MOUSE_PAN_SPEED screen pixels per step
+def pan_mouse(steps_x, steps_y):
+    screen_w, screen_h = screen
+    pan(steps_x * MOUSE_PAN_SPEED / screen_w, steps_y * MOUSE_PAN_SPEED / screen_h)
+
+# called on each frame with picamera2 to move the view towards scale.window
+# sets the ScalerCrop at most once per frame, however many inputs changed the view
+def viewport_callback(request):
+    target = getattr(scale, 'window', None)
+    if target is None:
+        return
+    position = getattr(viewport_callback, 'position', target)
+    if position != target:
+        position = tuple(p + (t - p) * VIEW_STEP for p, t in zip(position, target))
+        if max(abs(p - t) for p, t in zip(position, target)) <= 2:
+            position = target
+    viewport_callback.position = position
+    # only whole sensor pixels are applied, the position keeps the fractions
+    window = sensor_window(position)
+    if window != getattr(viewport_callback, 'window', None):
+        viewport_callback.window = window
+        settle_motion()
+        if TELEMETRY and telemetry().input_time is not None:
+            expect_crop(window)
+
+    # when stabilising, the crop follows the shaking of the view
+    crop = window
+    offset = getattr(stabilise_callback, 'offset', None)
+    if offset is not None:
+        x, y, width, height = position
+        crop = sensor_window(view_window(x + offset[0], y + offset[1], width, height))
+    if crop != getattr(viewport_callback, 'crop', None):
+        viewport_callback.crop = crop
+        camera.set_controls({'ScalerCrop': crop})
+
+# called on each frame with picamera2 at high magnification if STABILISE is set
+# measures how far the view moved since the last frame by phase correlation of
+# small gray copies, keeping the spectrum of the last one. Moving the crop moves
+# the view as well, so the change of the frame's ScalerCrop is added back, the
+# rest is shaking, which stabilise_callback.offset follows
+def stabilise_callback(request):
+    state = stabilise_callback
+    if not STABILISE or factor < STABILISE_MIN_FACTOR or 'cv2' not in globals():
+        state.offset = None
+        state.spectrum = None
+        return
+    crop = request.get_metadata().get('ScalerCrop') or getattr(viewport_callback, 'crop', None)
+    if crop is None:
+        return
+    frame_w, frame_h = camera.camera_config['main']['size']
+    small_w = STABILISE_SIZE
+    small_h = frame_h * small_w // frame_w
+    small = frame_buffer('stabilise', (small_h, small_w))
+    # only every few pixels are read, the resize averages what's left, as reading
+    # the whole frame would take longer than the rest of the measurement
+    step = max(1, frame_w // (2 * small_w))
+    with MappedArray(request, "main") as m:
+        gray = frame_gray(m.array)[:frame_h:step, :frame_w:step]
+        cv2.resize(gray, (small_w, small_h), dst=small, interpolation=cv2.INTER_AREA)
+
+    window = getattr(state, 'window', None)
+    if window is None or window.shape != small.shape:
+        # a Hann window avoids the edges of the image being taken as structure
+        state.window = cv2.createHanningWindow((small_w, small_h), cv2.CV_32F)
+    spectrum = np.fft.rfft2(small * state.window)
+    previous, previous_crop = getattr(state, 'spectrum', None), getattr(state, 'crop', None)
+    state.spectrum, state.crop = spectrum, crop
+    offset = getattr(state, 'offset', None) or (0, 0)
+    if previous is None or previous.shape != spectrum.shape or previous_crop[2:] != crop[2:]:
+        # nothing to compare with, or zooming
+        state.offset = offset
+        return
+
+    cross = previous * np.conj(spectrum)
+    cross /= np.abs(cross) + 1e-9
+    correlation = np.fft.irfft2(cross, s=small.shape)
+    peak_y, peak_x = np.unravel_index(np.argmax(correlation), correlation.shape)
+    shift = []
+    for peak, axis, size in ((peak_x, 1, small_w), (peak_y, 0, small_h)):
+        # sub-pixel position from a parabola through the peak and its neighbours
+        before = correlation[(peak_y, (peak - 1) % size)] if axis == 1 else correlation[((peak - 1) % size, peak_x)]
+        after = correlation[(peak_y, (peak + 1) % size)] if axis == 1 else correlation[((peak + 1) % size, peak_x)]
+        centre = correlation[peak_y, peak_x]
+        curvature = before - 2 * centre + after
+        fraction = (before - after) / (2 * curvature) if curvature < 0 else 0
+        shift.append(((peak + size // 2) % size - size // 2) + fraction)
+
+    # movement of the view in sensor pixels, without the part caused by the crop
+    pixel_size = crop[2] / small_w
+    shake_x = -shift[0] * pixel_size + crop[0] - previous_crop[0]
+    shake_y = -shift[1] * pixel_size + crop[1] - previous_crop[1]
+    offset_x = offset[0] * STABILISE_DECAY + shake_x
+    offset_y = offset[1] * STABILISE_DECAY + shake_y
+    if abs(offset_x) > STABILISE_MAX_SHIFT * crop[2] or abs(offset_y) > STABILISE_MAX_SHIFT * crop[3]:
+        offset_x, offset_y = 0, 0
+    state.offset = (offset_x, offset_y)
 
 # change scale factor by given amount
 def zoom(change_by):
@@ -270,7 +1139,7 @@ def brightness(change_by):
         val = brightness.val + change_by
         if min_val <= val <= max_val:
             brightness.val = val
-            camera.set_controls({'Brightness': val})
+            schedule_controls({'Brightness': val})
             overlay(f'{val:.2f}')
 
 
@@ -286,7 +1155,7 @@ def contrast(multiply_by):
         val = contrast.contrast * multiply_by
         if min_contrast <= val <= max_contrast:
             contrast.contrast = val
-            camera.set_controls({'Contrast': val})
+            schedule_controls({'Contrast': val})
             overlay(f'{val:.2f}')
     elif hasattr(camera, 'contrast'):
         # legacy picamera, uses range from -100 to 100 so just stepping +-10
@@ -306,7 +1175,7 @@ def saturation(multiply_by):
         val = saturation.val * multiply_by
         if min_val <= val <= max_val:
             saturation.val = val
-            camera.set_controls({'Saturation': val})
+            schedule_controls({'Saturation': val})
             overlay(f'{val:.2f}')
 
 # multiply current sharpness by given value
@@ -320,7 +1189,7 @@ def sharpness(multiply_by):
         val = sharpness.val * multiply_by
         if min_val <= val <= max_val:
             sharpness.val = val
-            camera.set_controls({'Sharpness': val})
+            schedule_controls({'Sharpness': val})
             overlay(f'{val:.2f}')
 
 # change focus (only on supported cameras like the v3 camera, using picamera2)
@@ -331,18 +1200,24 @@ def focus(multiply_by = None):
 
     # update autofocus (only supported on picamera2)
     if hasattr(camera, 'camera_controls') and 'AfMode' in camera.camera_controls:
-        current_val = camera.capture_metadata()['LensPosition']
         if multiply_by is None:
-            overlay(f'Auto: {current_val:.2f}')
-            camera.set_controls({'AfMode': controls.AfModeEnum.Auto, 'AfMetering': controls.AfMeteringEnum.Auto})
-            camera.autofocus_cycle()
-            current_val = camera.capture_metadata()['LensPosition']
-            overlay(f'Auto: {current_val:.2f}')
+            if getattr(focus, 'val', None) is not None:
+                overlay(f'Auto: {focus.val:.2f}')
+            def autofocus(generation):
+                if run_autofocus({'AfMetering': controls.AfMeteringEnum.Auto}, generation) is not None:
+                    overlay(f'Auto: {focus.val:.2f}')
+            schedule_controls({}, autofocus=autofocus)
+        elif getattr(focus, 'val', None) is None:
+            # current position unknown yet, read it in the background
+            def task():
+                focus.val = camera.capture_metadata()['LensPosition']
+                focus(multiply_by)
+            schedule_controls({}, task=task, cancel_autofocus=True)
         else:
-            camera.set_controls({'AfMode': controls.AfModeEnum.Manual})
-            val = current_val * multiply_by
-            camera.set_controls({'LensPosition': val})
-            overlay(f'{val:.2f}')
+            focus.val *= multiply_by
+            schedule_controls({'AfMode': controls.AfModeEnum.Manual, 'LensPosition': focus.val},
+                              cancel_autofocus=True)
+            overlay(f'{focus.val:.2f}')
 
 def quit():
     global devices    
@@ -350,51 +1225,668 @@ def quit():
     for dev in devices:
         dev.ungrab()
 
-def save_photo(filename = ''):
+# current values of the camera controls changed by magni
+def current_controls():
+    values = {
+        'Brightness': getattr(brightness, 'val', BRIGHTNESS),
+        'Contrast': getattr(contrast, 'contrast', CONTRAST),
+        'Saturation': getattr(saturation, 'val', SATURATION),
+        'Sharpness': getattr(sharpness, 'val', SHARPNESS)
+    }
+    if hasattr(scale, 'window'):
+        values['ScalerCrop'] = sensor_window(scale.window)
+    if getattr(focus, 'val', None) is not None:
+        values['AfMode'] = controls.AfModeEnum.Manual
+        values['LensPosition'] = focus.val
+    return {name: value for name, value in values.items() if name in camera.camera_controls}
+
+# YUV420 frame of the current view at full sensor resolution and its (width, height)
+# switches to a still mode for one frame with the same crop on the sensor and an
+# output just as big, then back to the preview. A new mode starts with the
+# controls of its configuration, so the current ones are added to both
+# must run in the control thread, returns None if not supported
+def capture_full_resolution():
+    if not hasattr(camera, 'switch_mode_and_capture_array'):
+        return None
+    try:
+        x, y, width, height = getattr(scale, 'window', camera.camera_properties['ScalerCropMaximum'])
+        current = current_controls()
+        still = camera.create_still_configuration(
+            main={'size': (width, height), 'format': 'YUV420'},
+            sensor={'output_size': camera.sensor_resolution},
+            transform=camera.camera_config['transform'],
+            buffer_count=1, controls=current)
+        camera.align_configuration(still)
+        camera.camera_config['controls'].update(current)
+        capture_full_resolution.active = True
+        try:
+            array = camera.switch_mode_and_capture_array(still, 'main')
+        finally:
+            capture_full_resolution.active = False
+        return array, still['main']['size']
+    except Exception as e:
+        print('Full resolution capture failed:', e)
+        return None
+
+# whether a full resolution capture has more pixels of the view than the preview,
+# only at low magnification, where the crop is wider than the preview frame
+def full_resolution_readout():
+    if not READOUT_FULL_RESOLUTION or not hasattr(camera, 'switch_mode_and_capture_array'):
+        return False
+    window = getattr(scale, 'window', camera.camera_properties['ScalerCropMaximum'])
+    return window[2] > camera.camera_config['main']['size'][0]
+
+# gray image of the current view for OCR, at full sensor resolution if that has
+# more pixels than the preview, must run in the control thread
+def capture_for_ocr():
+    captured = capture_full_resolution() if full_resolution_readout() else None
+    if captured is None:
+        return gray_copy(camera.capture_array('main'))
+    array, (width, height) = captured
+    return np.ascontiguousarray(array[:height, :width])
+
+# photo of the current view as BGR image for opencv, with picamera2
+# the preview frame is converted right away, so its buffer goes back to the camera
+def capture_photo():
+    if PHOTO_FULL_RESOLUTION:
+        # switching modes is done by the control thread, between control changes
+        captured = []
+        done = threading.Event()
+        def task():
+            captured.append(capture_full_resolution())
+            done.set()
+        schedule_controls({}, task=task)
+        if done.wait(5) and captured[0] is not None:
+            array, (width, height) = captured[0]
+            return cv2.cvtColor(array, cv2.COLOR_YUV2BGR_I420)[:, :width]
+
+    request = camera.capture_request()
+    try:
+        with MappedArray(request, 'main') as m:
+            if PREVIEW_FORMAT == 'YUV420':
+                # picamera2 can't encode YUV420 images, so convert with opencv
+                width, height = camera.camera_config['main']['size']
+                return cv2.cvtColor(m.array, cv2.COLOR_YUV2BGR_I420)[:, :width]
+            # BGR888 frames hold RGB pixels
+            return cv2.cvtColor(m.array, cv2.COLOR_RGB2BGR)
+    finally:
+        request.release()
+
+# encode a photo as JPEG and write it, runs in the encoder thread
+def encode_photo(image, filename):
+    cv2.imwrite(filename, image, [cv2.IMWRITE_JPEG_QUALITY, PHOTO_QUALITY])
+    print('Saved photo', filename)
+
+# take count photos PHOTO_BURST_INTERVAL_S apart in the background, without
+# stopping the preview. Photos are captured in one thread and encoded in another,
+# so slow encoding doesn't delay the next photo of a burst
+# returns a future that is done when all photos are saved
+def save_photo(filename = '', count = 1):
     global camera
-    if len(filename) == 0:
-        timestamp = datetime.now().isoformat()
-        filename = f'/home/pi/{timestamp}.jpg'
-    if hasattr(camera, 'capture_file'):
-        # saves the preview stream as an image
-        camera.capture_file(filename)
-    else:
-        camera.stop_preview()
-        camera.capture(filename)
-        camera.start_preview()
+    if not hasattr(save_photo, 'capturer'):
+        save_photo.capturer = ThreadPoolExecutor(1, thread_name_prefix='capture')
+        save_photo.encoder = ThreadPoolExecutor(1, thread_name_prefix='encode')
+
+    def capture():
+        try:
+            saved = None
+            next_photo = time.monotonic()
+            for i in range(count):
+                if i > 0:
+                    next_photo += PHOTO_BURST_INTERVAL_S
+                    time.sleep(max(0, next_photo - time.monotonic()))
+                name = filename
+                if len(name) == 0:
+                    timestamp = datetime.now().isoformat()
+                    name = os.path.join(PHOTO_DIR, f'{timestamp}.jpg')
+                if hasattr(camera, 'capture_request') and 'cv2' in globals():
+                    saved = save_photo.encoder.submit(encode_photo, capture_photo(), name)
+                elif hasattr(camera, 'capture_file'):
+                    camera.capture_file(name)
+                else:
+                    # legacy picamera, the video port doesn't interrupt the preview
+                    camera.capture(name, use_video_port=True)
+            if saved is not None:
+                saved.result()
+        except Exception as e:
+            print('Failed to save photo:', e)
+    return save_photo.capturer.submit(capture)
+
+# start a command of the readout worker, stop_readout_processes can stop it
+# returns None if the command doesn't exist
+def start_readout_process(args, stdin=None, stdout=None):
+    if not hasattr(start_readout_process, 'running'):
+        start_readout_process.running = set()
+    try:
+        process = subprocess.Popen(args, stdin=stdin, stdout=stdout)
+    except OSError as e:
+        print('Readout failed:', e)
+        return None
+    start_readout_process.running.add(process)
+    return process
+
+# run a command of the readout worker, with text given as input if not None
+# returns its output as text, or None if it failed or was cancelled
+def run_readout_process(args, text=None, cancel=None):
+    process = start_readout_process(args, subprocess.PIPE, subprocess.PIPE)
+    if process is None:
+        return None
+    if cancel is not None and cancel.is_set():
+        process.terminate()
+    output, errors = process.communicate(text)
+    start_readout_process.running.discard(process)
+    if process.returncode != 0:
+        return None
+    return output.decode('utf-8', errors='replace')
+
+# stop all commands currently run by the readout worker
+def stop_readout_processes():
+    for process in list(getattr(start_readout_process, 'running', [])):
+        if process.poll() is None:
+            process.terminate()
+
+# OCR for gray images, returns a generator function ocr(image, (height, width), cancel)
+# that yields the text as soon as parts of it are recognised
+# tesserocr keeps the language model loaded between calls and recognises line by
+# line, one image at a time, otherwise the tesseract command reads the image from
+# stdin instead of a temporary file and is stopped when cancelled
+def ocr_engine():
+    try:
+        import tesserocr
+        api = tesserocr.PyTessBaseAPI(lang=OCR_LANG)
+        lock = threading.Lock()
+        print('Using tesserocr')
+
+        def ocr(image, size, cancel):
+            height, width = size
+            with lock:
+                api.SetImageBytes(image, width, height, 1, width)
+                for _, box, _, _ in api.GetComponentImages(tesserocr.RIL.TEXTLINE, True):
+                    if cancel.is_set():
+                        return
+                    api.SetRectangle(box['x'], box['y'], box['w'], box['h'])
+                    yield api.GetUTF8Text()
+        return ocr
+    except (ImportError, RuntimeError) as e:
+        print('Using tesseract command for OCR:', e)
+
+    def ocr(image, size, cancel):
+        height, width = size
+        args = ['tesseract', 'stdin', 'stdout', '-l', OCR_LANG]
+        process = start_readout_process(args, subprocess.PIPE, subprocess.PIPE)
+        if process is None:
+            return
+
+        def watch():
+            while process.poll() is None:
+                if cancel.wait(0.1):
+                    process.terminate()
+                    return
+        threading.Thread(target=watch, daemon=True).start()
+        try:
+            process.stdin.write(f'P5 {width} {height} 255\n'.encode() + image)
+            process.stdin.close()
+            for line in process.stdout:
+                yield line.decode('utf-8', errors='replace')
+        except BrokenPipeError:
+            pass
+        process.wait()
+        start_readout_process.running.discard(process)
+    return ocr
+
+# binarise and straighten a gray image for OCR, tesseract is faster and more
+# accurate on clean black text on white. Otsu's threshold separates text and
+# background, which is made white as it covers most of the image. The skew is
+# the angle of the smallest rectangle around the text, found on a small copy
+def prepare_for_ocr(image, size):
+    if 'cv2' not in globals():
+        return image
+    height, width = size
+    gray = np.frombuffer(image, dtype=np.uint8).reshape(height, width)
+    _, binary = cv2.threshold(gray, 0, 255, cv2.THRESH_BINARY | cv2.THRESH_OTSU)
+    if cv2.countNonZero(binary) < binary.size // 2:
+        cv2.bitwise_not(binary, dst=binary)
+
+    ratio = min(1, 800 / max(height, width))
+    small = cv2.resize(binary, None, fx=ratio, fy=ratio, interpolation=cv2.INTER_AREA)
+    text = cv2.findNonZero(cv2.compare(small, 128, cv2.CMP_LT))
+    if text is None or len(text) < 100:
+        return binary.tobytes()
+    angle = cv2.minAreaRect(text)[2]
+    # opencv gives the angle in -90..0 or 0..90 depending on the version
+    if angle > 45:
+        angle -= 90
+    elif angle < -45:
+        angle += 90
+    if 0.1 < abs(angle) <= OCR_MAX_SKEW:
+        rotation = cv2.getRotationMatrix2D((width / 2, height / 2), angle, 1)
+        binary = cv2.warpAffine(binary, rotation, (width, height), flags=cv2.INTER_NEAREST,
+                                borderMode=cv2.BORDER_CONSTANT, borderValue=255)
+    return binary.tobytes()
+
+# remove hyphens at end of line and append the next line, so TTS won't read them out
+def fix_hyphens(text):
+    return re.sub(r'(\w)-\n+(\w)', r'\1\2', text)
+
+# split streamed text into sentences, ending at empty lines or at punctuation
+# followed by an uppercase letter, so abbreviations like "e.g. the" stay together
+# a hyphen at the end of the text so far waits for the next part of the word
+def split_sentences(parts):
+    pending = ''
+    short = ''
+    for part in parts:
+        pending = fix_hyphens(pending + part)
+        start = 0
+        for end in re.finditer(r'[.!?]+["\')\]]*\s+(?=["\'(\[]*([^\W\d_]))|\n\s*\n', pending):
+            if end.group(1) is not None and not end.group(1).isupper():
+                continue
+            sentence = ' '.join((short + ' ' + pending[start:end.end()]).split())
+            start = end.end()
+            # too short to be a sentence of its own, e.g. after "Dr."
+            if len(sentence) < MIN_SENTENCE_LENGTH:
+                short = sentence
+            else:
+                short = ''
+                yield sentence
+        pending = pending[start:]
+    sentence = ' '.join((short + ' ' + pending).split())
+    if sentence:
+        yield sentence
+
+# synthesise each sentence from the queue into its own wav file for the player
+# None in the queue ends the speech
+# the sentences and their audio are also added to record for the readout cache
+def synthesise_sentences(sentences, speech, cancel):
+    count = 0
+    while True:
+        sentence = sentences.get()
+        if sentence is None or cancel.is_set():
+            break
+        wav = os.path.join(READOUT_TMP_DIR, f'magni-{os.getpid()}-{count}.wav')
+        count += 1
+        audio = cached_speech(sentence)
+        if audio is not None:
+            with open(wav, 'wb') as f:
+                f.write(audio)
+            speech.put(wav)
+        elif run_readout_process(['pico2wave', '-w', wav, '-l', TTS_LANG], sentence.encode(), cancel) is not None:
+            with open(wav, 'rb') as f:
+                cache_speech(sentence, f.read())
+            speech.put(wav)
+    speech.put(None)
+
+# play the wav files from the queue in order, and delete them afterwards
+# starts with the plop sound, so the user knows reading is about to start
+def play_speech(speech, cancel):
+    audio = shlex.split(AUDIO)
+    started = False
+    while True:
+        wav = speech.get()
+        if wav is None:
+            break
+        if not cancel.is_set():
+            if not started:
+                run_readout_process(audio + ['plop.wav'], cancel=cancel)
+                started = True
+            run_readout_process(audio + [wav], cancel=cancel)
+        os.remove(wav)
+
+# read out the text parts given by OCR, runs in a thread of the readout worker
+# sentences are synthesised and played while the next ones are recognised
+# the recognised parts are added to the readout cache for the given page, a
+# tuple of image hash and thumbnail, unless it is None
+def readout_job(parts, cancel, busy, page):
+    sentences = queue.Queue()
+    speech = queue.Queue()
+    recognised = []
+    synthesiser = threading.Thread(target=synthesise_sentences, args=(sentences, speech, cancel))
+    player = threading.Thread(target=play_speech, args=(speech, cancel))
+    try:
+        subprocess.Popen(shlex.split(AUDIO) + ['plop.wav'], stderr=subprocess.DEVNULL)
+        synthesiser.start()
+        player.start()
+        for sentence in split_sentences(recognised.append(part) or part for part in parts):
+            if cancel.is_set():
+                break
+            sentences.put(sentence)
+    finally:
+        sentences.put(None)
+        if synthesiser.is_alive():
+            synthesiser.join()
+        if player.is_alive():
+            player.join()
+        if not cancel.is_set() and page is not None and ''.join(recognised).strip():
+            cache_page(*page, recognised)
+        busy.clear()
+
+# perceptual hash of a gray image, compares the mean brightness of neighbouring
+# cells in a grid, so it stays the same for small changes like noise or exposure
+# a cell only counts as brighter by more than 2 gray values, so flat areas like
+# the margins of a page don't change with noise
+# it only finds candidate pages, different labels on the same kind of packaging
+# can have the same hash, so a match is checked with same_page()
+def image_hash(image, size):
+    height, width = size
+    n = READOUT_CACHE_HASH_SIZE
+    cell_h, cell_w = height // n, width // (n + 1)
+    gray = np.frombuffer(image, dtype=np.uint8).reshape(height, width)
+    cells = gray[:cell_h * n, :cell_w * (n + 1)].reshape(n, cell_h, n + 1, cell_w).mean(axis=(1, 3))
+    bits = cells[:, 1:] > cells[:, :-1] + 2
+    return int.from_bytes(np.packbits(bits).tobytes(), 'big')
+
+# small copy of a gray image, at most READOUT_CACHE_THUMBNAIL_WIDTH pixels wide,
+# which still shows single characters, for checking that a cached page is the same
+# averages blocks of pixels with numpy only, as opencv may not be installed
+def page_thumbnail(image, size):
+    height, width = size
+    gray = np.frombuffer(image, dtype=np.uint8).reshape(height, width)
+    step = -(-width // READOUT_CACHE_THUMBNAIL_WIDTH)
+    thumbnail_h, thumbnail_w = height // step, width // step
+    blocks = gray[:thumbnail_h * step, :thumbnail_w * step].reshape(thumbnail_h, step, thumbnail_w, step)
+    return (blocks.sum(axis=(1, 3), dtype=np.uint32) // (step * step)).astype(np.int16)
+
+# whether two thumbnails show the same page, only a few pixels may differ
+# clearly, a changed digit or word changes many more
+def same_page(thumbnail, other):
+    if thumbnail.shape != other.shape:
+        return False
+    changed = np.abs(thumbnail - other) > READOUT_CACHE_PIXEL_DIFFERENCE
+    return np.count_nonzero(changed) <= READOUT_CACHE_CHANGED_PIXELS
+
+# caches of the readout worker: the recognised text of the last
+# READOUT_CACHE_PAGES pages, and an LRU cache of speech keyed by the exact
+# sentence and language, up to READOUT_CACHE_BYTES
+def readout_cache():
+    if not hasattr(readout_cache, 'pages'):
+        readout_cache.pages = collections.deque(maxlen=READOUT_CACHE_PAGES)
+        readout_cache.speech = collections.OrderedDict()
+        readout_cache.bytes = 0
+        readout_cache.stats = {'hits': 0, 'misses': 0, 'speech hits': 0, 'evictions': 0}
+    return readout_cache
+
+# recognised text parts of a cached page, if its image hash differs in at most
+# READOUT_CACHE_MAX_DISTANCE bits and its thumbnail is the same
+def cached_page(image_hash, thumbnail):
+    cache = readout_cache()
+    for entry in cache.pages:
+        if (entry['language'] == OCR_LANG and bin(entry['hash'] ^ image_hash).count('1') <= READOUT_CACHE_MAX_DISTANCE
+                and same_page(entry['thumbnail'], thumbnail)):
+            cache.pages.remove(entry)
+            cache.pages.append(entry)
+            cache.stats['hits'] += 1
+            print_readout_cache()
+            return entry['parts']
+    cache.stats['misses'] += 1
+    return None
+
+# add a page to the cache, the oldest one is dropped when it is full
+def cache_page(image_hash, thumbnail, parts):
+    cache = readout_cache()
+    cache.pages.append({'hash': image_hash, 'thumbnail': thumbnail, 'parts': parts, 'language': OCR_LANG})
+    print_readout_cache()
+
+# synthesised speech of a sentence, if it is in the cache
+def cached_speech(sentence):
+    cache = readout_cache()
+    audio = cache.speech.get((TTS_LANG, sentence))
+    if audio is not None:
+        cache.speech.move_to_end((TTS_LANG, sentence))
+        cache.stats['speech hits'] += 1
+    return audio
+
+# add speech to the cache, dropping the least recently used if it gets too big
+def cache_speech(sentence, audio):
+    cache = readout_cache()
+    if len(audio) > READOUT_CACHE_BYTES:
+        return
+    key = (TTS_LANG, sentence)
+    if key in cache.speech:
+        cache.bytes -= len(cache.speech.pop(key))
+    cache.speech[key] = audio
+    cache.bytes += len(audio)
+    while cache.bytes > READOUT_CACHE_BYTES:
+        key, evicted = cache.speech.popitem(last=False)
+        cache.bytes -= len(evicted)
+        cache.stats['evictions'] += 1
+
+# show the cache state, for tuning its size and hash distance
+def print_readout_cache():
+    cache = readout_cache()
+    stats = cache.stats
+    print(f'Readout cache: {len(cache.pages)} pages, {len(cache.speech)} sentences, {cache.bytes / 1024:.0f} KiB,',
+          f'{stats["hits"]} hits, {stats["misses"]} misses, {stats["speech hits"]} speech hits,',
+          f'{stats["evictions"]} evictions')
+
+# OCR of an image while the view is still, runs in its own thread of the readout
+# worker with lower priority, so the preview and a readout get the CPU first
+# stores the recognised text parts in prefetch['parts'] unless cancelled
+def prefetch_job(ocr, size, image, prefetch):
+    os.setpriority(os.PRIO_PROCESS, threading.get_native_id(), PREFETCH_NICE)
+    image = prepare_for_ocr(image, size)
+    parts = list(ocr(image, size, prefetch['cancel']))
+    if not prefetch['cancel'].is_set():
+        prefetch['parts'] = parts
+
+# text parts of an image for the readout job, taken from the prefetch if it's
+# for the same view, otherwise recognised now
+def readout_parts(ocr, size, image, cancel, prefetch):
+    if prefetch is not None:
+        prefetch['thread'].join()
+        if prefetch['parts'] is not None:
+            yield from prefetch['parts']
+            return
+    image = prepare_for_ocr(image, size)
+    yield from ocr(image, size, cancel)
+
+# Readout worker process, receives these messages:
+# ('read', (height, width), view) followed by the bytes of a gray image to read out
+# ('prefetch', (height, width), view) followed by the bytes of a gray image to OCR
+# in the background, view identifies the still camera view it shows
+# ('discard',) to drop the prefetched text as the view changed
+# ('stop',) to stop reading
+def readout_worker(connection, busy):
+    # own process group, so the worker can be stopped with all commands it runs
+    os.setsid()
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    load_cv2()
+    ocr = ocr_engine()
+    job = None
+    cancel = threading.Event()
+    prefetch = None
+    # the last prefetch, it may still be stopping after being discarded
+    prefetch_thread = None
+    while True:
+        try:
+            message = connection.recv()
+        except EOFError:
+            break
+        command = message[0]
+        # a failing job mustn't stop the worker, the next key press may work
+        try:
+            if command == 'prefetch':
+                image = connection.recv_bytes()
+                size, view = message[1], message[2]
+                # only one prefetch at a time, and none while reading
+                if busy.is_set() or (prefetch_thread is not None and prefetch_thread.is_alive()):
+                    continue
+                prefetch = {'view': view, 'size': size, 'cancel': threading.Event(), 'parts': None}
+                prefetch_thread = threading.Thread(target=prefetch_job, args=(ocr, size, image, prefetch))
+                prefetch['thread'] = prefetch_thread
+                prefetch_thread.start()
+                continue
+            if command == 'discard':
+                if prefetch is not None:
+                    prefetch['cancel'].set()
+                    prefetch = None
+                continue
+
+            if job is not None and job.is_alive():
+                cancel.set()
+                stop_readout_processes()
+                job.join()
+            if command == 'read':
+                image = connection.recv_bytes()
+                size, view = message[1], message[2]
+                busy.set()
+                cancel = threading.Event()
+                page = (image_hash(image, size), page_thumbnail(image, size))
+                parts = None
+                # a prefetch of the same view is used first, it's at least as fresh as the
+                # cache, unless it was OCR of a smaller image than the one to read
+                if prefetch is not None and (view is None or prefetch['view'] != view or prefetch['size'][1] < size[1]):
+                    prefetch['cancel'].set()
+                    prefetch = None
+                if prefetch is None:
+                    parts = cached_page(*page)
+                if parts is not None:
+                    page = None
+                else:
+                    parts = readout_parts(ocr, size, image, cancel, prefetch)
+                job = threading.Thread(target=readout_job, args=(parts, cancel, busy, page))
+                prefetch = None
+                job.start()
+            else:
+                busy.clear()
+        except Exception as e:
+            print('Readout failed:', e)
+            busy.clear()
+
+# start the readout worker, it's forked if no other threads run yet, which is
+# quick, otherwise started as a new python process, as forking a process with
+# threads (like the camera's) isn't safe
+def start_readout_worker():
+    if not READOUT_WORKER or 'numpy' not in sys.modules:
+        return
+    context = multiprocessing.get_context('fork' if threading.active_count() == 1 else 'spawn')
+    # sends to the worker in order, without blocking the camera or input handling
+    readout.sender = ThreadPoolExecutor(1, thread_name_prefix='readout')
+    readout.connection, worker_connection = context.Pipe()
+    readout.busy = context.Event()
+    worker = context.Process(target=readout_worker, args=(worker_connection, readout.busy),
+                             name='readout', daemon=True)
+    worker.start()
+    # the camera thread starts using the worker once it's set
+    readout.worker = worker
+
+# stop the readout worker and everything it runs
+def stop_readout_worker():
+    if hasattr(readout, 'worker') and readout.worker.is_alive():
+        try:
+            os.killpg(readout.worker.pid, signal.SIGTERM)
+        except ProcessLookupError:
+            # still starting up, it has no process group of its own yet
+            readout.worker.terminate()
+
+# send a message to the readout worker, followed by the bytes of image if given
+def send_to_worker(message, image=None):
+    def send():
+        readout.connection.send(message)
+        if image is not None:
+            readout.connection.send_bytes(image.reshape(-1))
+    readout.sender.submit(send)
+
+# gray copy of a preview frame, for OCR
+def gray_copy(array):
+    if PREVIEW_FORMAT == 'YUV420':
+        width, height = camera.camera_config['main']['size']
+        return np.ascontiguousarray(yuv_planes(array)[0][:, :width])
+    if 'cv2' in globals():
+        return cv2.cvtColor(array, cv2.COLOR_BGR2GRAY)
+    return np.ascontiguousarray(array[:, :, 1])
+
+# called on each frame with picamera2 to start OCR in the background once the view
+# has been still for PREFETCH_STABLE_S, and to drop its result when the view changes
+def prefetch_callback(request):
+    still_since = max(getattr(motion_callback, 'last_motion', 0), getattr(motion_callback, 'ignore_until', 0))
+    if still_since != getattr(prefetch_callback, 'still_since', None):
+        if getattr(prefetch_callback, 'sent', None) == getattr(prefetch_callback, 'view', 0):
+            send_to_worker(('discard',))
+        prefetch_callback.still_since = still_since
+        prefetch_callback.view = getattr(prefetch_callback, 'view', 0) + 1
+
+    if getattr(prefetch_callback, 'sent', None) != prefetch_callback.view \
+            and time.monotonic() - still_since >= PREFETCH_STABLE_S and not readout.busy.is_set():
+        prefetch_callback.sent = prefetch_callback.view
+        # at low magnification readout captures more pixels than the preview has,
+        # the text recognised in the preview would be worse
+        if full_resolution_readout():
+            return
+        with MappedArray(request, "main") as m:
+            image = gray_copy(m.array)
+        send_to_worker(('prefetch', image.shape, prefetch_callback.view), image)
 
 def readout():
     global factor
     global bg_process
 
+    overlay('')
+    if hasattr(readout, 'worker') and readout.worker.is_alive() and hasattr(camera, 'capture_array'):
+        if readout.busy.is_set():
+            # if the worker is reading, just stop it and do nothing
+            send_to_worker(('stop',))
+        else:
+            overlay('Reading')
+            readout.busy.set()
+            # the worker can use the prefetched text if the view didn't change since
+            # and the prefetched frame wasn't smaller than the capture
+            view = getattr(prefetch_callback, 'view', None)
+            if getattr(prefetch_callback, 'sent', None) != view:
+                view = None
+            # capture in the control thread, which owns the camera mode
+            def task():
+                image = capture_for_ocr()
+                send_to_worker(('read', image.shape, view), image)
+            schedule_controls({}, task=task)
+        return
+
+    # without worker (e.g. on legacy OS) run OCR and TTS as shell commands via files
     # remove hyphens at end of line and append the next line, so TTS won't read them out
     # See https://unix.stackexchange.com/a/26289
     FIX_HYPHENS = "perl -i.original -p0e 's/(\w)-[\n]+(\w)/$1$2/igs' tmp.txt"
 
     # command to run OCR, remove hyphens, play a sound, run TTS and play the result
     cmd = f'tesseract tmp.jpg tmp -l {OCR_LANG} && {FIX_HYPHENS} && {AUDIO} plop.wav && pico2wave -w tmp.wav -l {TTS_LANG} < tmp.txt && {AUDIO} tmp.wav'
-    overlay('')
     if bg_process != None and bg_process.poll() == None:
         # if background process is running, just kill it and do nothing
         os.killpg(os.getpgid(bg_process.pid), signal.SIGTERM)
     else:
         subprocess.call(f'{AUDIO} plop.wav', shell=True)
-        save_photo('tmp.jpg')
+        save_photo('tmp.jpg').result()
         overlay('Reading')
         bg_process = subprocess.Popen(cmd, stdout=subprocess.PIPE, shell=True, preexec_fn=os.setsid)
 
+# allocate scratch buffers up front instead of on the first frames
+def allocate_frame_buffers(camera):
+    if 'numpy' in sys.modules:
+        width, height = camera.camera_config['main']['size']
+        if PREVIEW_FORMAT == 'YUV420':
+            stride = camera.camera_config['main']['stride']
+            frame_buffer('half', (height // 2, stride // 2))
+        else:
+            frame_buffer('gray', (height, width))
+
 # start displaying the default camera view
 def init_camera(width, height):
+    global PREVIEW_FORMAT
     try:
         # for current OS use picamera2
         picam2 = Picamera2()
         transform = Transform(hflip=1, vflip=1) if ROTATION == 180 else Transform()
+        size, frame_controls = (width, height), {}
+        if QUALITY_GOVERNOR:
+            # start at the level that worked last time on this Pi and screen
+            level = quality_levels().get(quality_key(width, height), 0)
+            level = min(level, len(QUALITY_LEVELS) - 1)
+            size, PREVIEW_FORMAT, frame_controls = quality_config(level, width, height)
+            govern_frame.level = level
         config = picam2.create_preview_configuration(
             # BGR888 uses 8 bit for actual RGB and no alpha channel
             # this simplifies color mode changes with opencv
-            main={'size': (width, height), 'format': 'BGR888'},
-            transform=transform)
+            # YUV420 gives the grayscale image directly as Y plane
+            main={'size': size, 'format': PREVIEW_FORMAT},
+            transform=transform, controls=frame_controls)
         picam2.configure(config)
+        allocate_frame_buffers(picam2)
         picam2.pre_callback = pre_callback
         picam2.start_preview(Preview.DRM, x=0, y=0, width=width, height=height) # no transform!
         picam2.start()
@@ -413,6 +1905,7 @@ def init_camera(width, height):
                 # set focus to the given fixed distance
                 picam2.set_controls({'AfMode': controls.AfModeEnum.Manual})
                 picam2.set_controls({'LensPosition': 100 / DISTANCE_TO_SURFACE_CM})
+                focus.val = 100 / DISTANCE_TO_SURFACE_CM
 
         print('Started picamera2', ROTATION)
         return picam2
@@ -427,7 +1920,21 @@ def init_camera(width, height):
 
 async def handle_events(device):
     async for event in device.async_read_loop():
-        if event.type == evdev.ecodes.EV_KEY and event.value == 0:
+        window = getattr(scale, 'window', None)
+
+        if event.type == evdev.ecodes.EV_REL and MOUSE_PAN:
+            if event.code == evdev.ecodes.REL_X: pan_mouse(event.value, 0)
+            elif event.code == evdev.ecodes.REL_Y: pan_mouse(0, event.value)
+
+        # arrow keys move the view on press and while held (key repeat)
+        elif event.type == evdev.ecodes.EV_KEY and event.value in (1, 2):
+            code = event.code
+            if code == evdev.ecodes.KEY_LEFT: pan(-PAN_STEP, 0)
+            elif code == evdev.ecodes.KEY_RIGHT: pan(PAN_STEP, 0)
+            elif code == evdev.ecodes.KEY_UP: pan(0, -PAN_STEP)
+            elif code == evdev.ecodes.KEY_DOWN: pan(0, PAN_STEP)
+
+        elif event.type == evdev.ecodes.EV_KEY and event.value == 0:
             code = event.code
             modifiers = device.active_keys()
             is_shift = evdev.ecodes.KEY_LEFTSHIFT in modifiers or evdev.ecodes.KEY_RIGHTSHIFT in modifiers
@@ -445,6 +1952,7 @@ async def handle_events(device):
             elif code == evdev.ecodes.KEY_ESC: quit()
             elif code == evdev.ecodes.KEY_ENTER: next_factor()
             elif code == evdev.ecodes.KEY_SLASH: color_mode()
+            elif code == evdev.ecodes.KEY_S and is_shift: save_photo(count=PHOTO_BURST)
             elif code == evdev.ecodes.KEY_S: save_photo()
             elif code == evdev.ecodes.KEY_R: readout()
             elif code == evdev.ecodes.KEY_Z and is_shift: zoom(-0.2)
@@ -482,26 +1990,93 @@ async def handle_events(device):
             elif code == evdev.ecodes.KEY_KP8: scale(8)
             elif code == evdev.ecodes.KEY_KP9: scale(9)
 
-button1 = Button(PIN_NUMBER_SCALE)
-button1.when_pressed = next_factor
-button2 = Button(PIN_NUMBER_COLOR)
-button2.when_pressed = color_mode
+        # only inputs that move the view are measured, see expect_crop
+        if TELEMETRY and getattr(scale, 'window', None) != window:
+            record_input(event)
 
-screen = screen_resolution_fbset()
-width, height = screen
-camera = init_camera(width, height)
-scale(factor)
+# all input devices like mouse and keyboard
+def input_devices():
+    return [evdev.InputDevice(fn) for fn in evdev.list_devices()]
 
-try:
-    devices = [evdev.InputDevice(fn) for fn in evdev.list_devices()]
+# push buttons at the GPIO pins, if gpiozero is installed
+def start_buttons():
+    global buttons
+    try:
+        from gpiozero import Button    # for external buttons
+    except ImportError:
+        return
+    button1 = Button(PIN_NUMBER_SCALE)
+    button1.when_pressed = next_factor
+    button2 = Button(PIN_NUMBER_COLOR)
+    button2.when_pressed = color_mode
+    buttons = [button1, button2]
+
+# handle the events of the input devices in the event loop
+def start_devices(open_devices):
+    global devices
+    devices = open_devices()
     for device in devices:
         device.grab()
         asyncio.ensure_future(handle_events(device))
+
+# start everything the preview doesn't need, once its first frame is shown
+async def start_deferred(open_devices):
     loop = asyncio.get_event_loop()
-    loop.run_forever()
+    await loop.run_in_executor(None, first_frame.wait, 10)
+    startup_phase('first frame')
+    start_devices(open_devices)
+    start_buttons()
+    startup_phase('input')
+    await loop.run_in_executor(None, load_cv2)
+    startup_phase('opencv')
+    start_readout_worker()
+    startup_phase('readout worker')
+    print_startup()
 
-finally:
-    if bg_process != None and bg_process.poll() == None:
-        os.killpg(os.getpgid(bg_process.pid), signal.SIGTERM)
-    camera.stop_preview()
-    camera.close()
+# start_camera and open_devices can be replaced, e.g. by a simulation without hardware
+def main(start_camera=init_camera, open_devices=input_devices):
+    global camera
+    global screen
+
+    startup_phase('imports')
+    if not FAST_BOOT:
+        load_cv2()
+        startup_phase('opencv')
+        # before the camera and buttons start their threads, so it can be forked
+        start_readout_worker()
+        start_buttons()
+        startup_phase('readout worker and buttons')
+
+    screen = screen_resolution()
+    width, height = screen
+    startup_phase('screen')
+    camera = start_camera(width, height)
+    if not hasattr(camera, 'pre_callback'):
+        # legacy picamera shows frames without a callback
+        first_frame.set()
+    scale(factor)
+    startup_phase('camera')
+    if TELEMETRY:
+        threading.Thread(target=telemetry_thread, name='telemetry', daemon=True).start()
+
+    try:
+        if FAST_BOOT:
+            asyncio.ensure_future(start_deferred(open_devices))
+        else:
+            start_devices(open_devices)
+            startup_phase('input')
+            print_startup()
+        loop = asyncio.get_event_loop()
+        loop.run_forever()
+
+    finally:
+        if bg_process != None and bg_process.poll() == None:
+            os.killpg(os.getpgid(bg_process.pid), signal.SIGTERM)
+        try:
+            stop_readout_worker()
+        finally:
+            camera.stop_preview()
+            camera.close()
+
+if __name__ == '__main__':
+    main()
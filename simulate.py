@@ -0,0 +1,280 @@
+#!/usr/bin/python3
+# Simulation harness for the control path of magni.py without camera hardware
+# - record: store the events of real input devices (mouse, keyboard) in a file
+# - replay: run magni.py with a stand-in camera and replay a recorded session,
+#   at real or accelerated speed, and report the input-to-control latency
+# Needs evdev (pip install evdev, Linux only), numpy and opencv
+import argparse
+import asyncio
+import json
+import threading
+import time
+from types import SimpleNamespace
+
+import evdev
+
+import bench
+import magni
+
+# enums of libcamera.controls used by magni, in case libcamera isn't installed
+FAKE_CONTROLS = SimpleNamespace(
+    AfModeEnum=SimpleNamespace(Manual=0, Auto=1, Continuous=2),
+    AfMeteringEnum=SimpleNamespace(Auto=0, Windows=1),
+    AfSpeedEnum=SimpleNamespace(Normal=0, Fast=1),
+    AfTriggerEnum=SimpleNamespace(Start=0, Cancel=1),
+    AfStateEnum=SimpleNamespace(Idle=0, Scanning=1, Focused=2, Failed=3),
+)
+
+# stand-in for Picamera2 with the parts used by magni, modelled on a camera v3
+# runs pre_callback on synthetic frames in its own thread like the real camera
+# and logs all control changes with their time
+class FakeCamera:
+    def __init__(self, width, height, fps=30, af_s=0.3, fmt='BGR888'):
+        self.camera_properties = {'ScalerCropMaximum': (0, 0, 4608, 2592)}
+        self.camera_controls = {
+            'Brightness': (-1.0, 1.0, 0.0),
+            'Contrast': (0.0, 32.0, 1.0),
+            'Saturation': (0.0, 32.0, 1.0),
+            'Sharpness': (0.0, 16.0, 1.0),
+            'AfMode': (0, 2, 0),
+            'LensPosition': (0.0, 32.0, 1.0),
+        }
+        self.camera_config = {'main': {'size': (width, height), 'format': fmt, 'stride': width}}
+        self.controls = {'LensPosition': 1.0}
+        self.af_state = 'Idle'
+        self.af_end = None
+        self.log = []
+        self.pre_callback = None
+        self.af_s = af_s
+        self.frame_s = 1 / fps
+        self.frames = 0
+        self.request = bench.FakeRequest(bench.synthetic_frame(width, height, fmt))
+        self.running = True
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    # deliver frames at the configured rate
+    def run(self):
+        next_frame = time.monotonic()
+        while self.running:
+            self.request.metadata = {'SensorTimestamp': time.monotonic_ns(),
+                                     'FrameDuration': int(self.frame_s * 1000000),
+                                     'ScalerCrop': self.controls.get('ScalerCrop')}
+            if self.pre_callback is not None:
+                self.pre_callback(self.request)
+            self.frames += 1
+            next_frame += self.frame_s
+            time.sleep(max(0, next_frame - time.monotonic()))
+
+    # an autofocus cycle scans for af_s after the trigger, then reports Focused
+    def set_controls(self, controls):
+        self.controls.update(controls)
+        trigger = controls.get('AfTrigger')
+        if trigger == magni.controls.AfTriggerEnum.Start:
+            self.af_state = 'Scanning'
+            self.af_end = time.monotonic() + self.af_s
+        elif trigger == magni.controls.AfTriggerEnum.Cancel:
+            self.af_state = 'Idle'
+        self.log.append((time.monotonic(), 'set_controls', dict(controls)))
+
+    def capture_metadata(self):
+        time.sleep(self.frame_s)
+        if self.af_state == 'Scanning' and time.monotonic() > self.af_end:
+            self.af_state = 'Focused'
+            self.log.append((time.monotonic(), 'focused', {}))
+        return {'LensPosition': self.controls['LensPosition'],
+                'AfState': getattr(magni.controls.AfStateEnum, self.af_state)}
+
+    def capture_file(self, filename):
+        time.sleep(self.frame_s)
+        self.log.append((time.monotonic(), 'capture_file', {'filename': filename}))
+
+    def capture_array(self, stream='main'):
+        time.sleep(self.frame_s)
+        return self.request.array.copy()
+
+    def set_overlay(self, overlay):
+        pass
+
+    def stop_preview(self):
+        pass
+
+    # wait for the last frame, a frame callback still running at exit aborts python
+    def close(self):
+        self.running = False
+        if self.thread is not threading.current_thread():
+            self.thread.join()
+
+# stand-in for an evdev InputDevice that plays back recorded events
+# events are delivered at their recorded offset from start, divided by speed
+class ReplayDevice:
+    def __init__(self, path, events, start, speed, session):
+        self.path = path
+        self.name = f'replay {path}'
+        self.events = events
+        self.start = start
+        self.speed = speed
+        self.session = session
+        self.keys = set()
+
+    async def async_read_loop(self):
+        t0 = self.session.t0
+        for record in self.events:
+            due = self.start
+            if self.speed > 0:
+                due += (record['time'] - t0) / self.speed
+            await asyncio.sleep(max(0, due - time.monotonic()))
+
+            if record['type'] == evdev.ecodes.EV_KEY:
+                if record['value'] == 0:
+                    self.keys.discard(record['code'])
+                else:
+                    self.keys.add(record['code'])
+            sec, usec = divmod(int(record['time'] * 1000000), 1000000)
+            event = evdev.InputEvent(sec, usec, record['type'], record['code'], record['value'])
+
+            dispatched = time.monotonic()
+            yield event
+            # magni handles each event before reading the next one
+            self.session.handled(record, due, dispatched, time.monotonic())
+        self.session.finished()
+
+    def active_keys(self):
+        return list(self.keys)
+
+    def grab(self):
+        pass
+
+    def ungrab(self):
+        pass
+
+# collects the latencies of a replayed session
+class ReplaySession:
+    def __init__(self, events, camera):
+        self.t0 = events[0]['time'] if events else 0
+        self.camera = camera
+        self.results = []
+        self.running = 0
+
+    def handled(self, record, due, dispatched, done):
+        self.results.append((record, due, dispatched, done))
+
+    def finished(self):
+        self.running -= 1
+        if self.running == 0:
+            # let the last control changes happen before stopping
+            asyncio.get_event_loop().call_later(0.5, magni.quit)
+
+    # latency per event from due time to handled and to the last control change
+    # the camera received before the next event was dispatched
+    def latencies(self):
+        rows = []
+        dispatch_times = [dispatched for _, _, dispatched, _ in self.results] + [float('inf')]
+        for i, (record, due, dispatched, done) in enumerate(self.results):
+            calls = [entry for entry in self.camera.log if dispatched <= entry[0] < dispatch_times[i + 1]]
+            applied = calls[-1][0] if calls else None
+            rows.append((record, (done - due) * 1000, (applied - due) * 1000 if applied else None, calls))
+        return rows
+
+def percentiles(values):
+    values = sorted(values)
+    if not values:
+        return 'n/a'
+    pick = lambda p: values[min(len(values) - 1, int(round(p / 100 * (len(values) - 1))))]
+    return f'p50 {pick(50):8.1f}  p90 {pick(90):8.1f}  p99 {pick(99):8.1f}  max {values[-1]:8.1f} ms'
+
+def code_name(record):
+    names = evdev.ecodes.bytype.get(record['type'], {}).get(record['code'], record['code'])
+    return names[0] if isinstance(names, list) else names
+
+def replay(args):
+    with open(args.session) as f:
+        events = [json.loads(line) for line in f if line.strip()]
+
+    width, height = (int(v) for v in args.size.split('x'))
+    camera = FakeCamera(width, height, args.fps, args.af_ms / 1000, args.format)
+    session = ReplaySession(events, camera)
+    magni.PREVIEW_FORMAT = args.format
+    magni.MappedArray = bench.FakeMappedArray
+    if not hasattr(magni, 'controls'):
+        magni.controls = FAKE_CONTROLS
+    magni.screen_resolution = lambda: (width, height)
+    magni.load_cv2()
+    magni.TELEMETRY = args.telemetry
+
+    def start_camera(width, height):
+        camera.pre_callback = magni.pre_callback
+        return camera
+
+    def open_devices():
+        start = time.monotonic() + 0.1
+        paths = sorted({event['device'] for event in events})
+        session.running = len(paths)
+        return [ReplayDevice(path, [e for e in events if e['device'] == path], start, args.speed, session)
+                for path in paths]
+
+    started = time.monotonic()
+    magni.main(start_camera, open_devices)
+    duration = time.monotonic() - started
+
+    rows = session.latencies()
+    if args.verbose:
+        for record, handled, applied, calls in rows:
+            applied_text = f'{applied:8.1f}' if applied is not None else '       -'
+            names = ', '.join(name for _, name, _ in calls)
+            print(f'{code_name(record):14} {record["value"]} handled {handled:8.1f} applied {applied_text} ms  {names}')
+    key_rows = [row for row in rows if row[0]['type'] == evdev.ecodes.EV_KEY and row[0]['value'] == 0]
+    print(f'events: {len(rows)}, key releases: {len(key_rows)}, frames: {camera.frames} in {duration:.1f} s')
+    print('handled:', percentiles([handled for _, handled, _, _ in key_rows]))
+    print('applied:', percentiles([applied for _, _, applied, _ in key_rows if applied is not None]))
+    if args.telemetry:
+        print('telemetry:', json.dumps(magni.telemetry_report()))
+
+async def record_device(device, out):
+    async for event in device.async_read_loop():
+        if event.type == evdev.ecodes.EV_SYN:
+            continue
+        out.write(json.dumps({'time': event.timestamp(), 'device': device.path,
+                              'type': event.type, 'code': event.code, 'value': event.value}) + '\n')
+        out.flush()
+
+def record(args):
+    paths = args.device or evdev.list_devices()
+    devices = [evdev.InputDevice(path) for path in paths]
+    for device in devices:
+        print('Recording', device.path, device.name)
+    print('Press Ctrl-c to stop')
+    with open(args.session, 'w') as out:
+        loop = asyncio.get_event_loop()
+        for device in devices:
+            asyncio.ensure_future(record_device(device, out))
+        try:
+            loop.run_forever()
+        except KeyboardInterrupt:
+            pass
+
+def main():
+    parser = argparse.ArgumentParser(description='Record input sessions and replay them against magni.py')
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    parser_record = commands.add_parser('record', help='record events of real input devices')
+    parser_record.add_argument('session', help='output file (JSON lines)')
+    parser_record.add_argument('--device', action='append', help='input device path, default all')
+    parser_record.set_defaults(run=record)
+
+    parser_replay = commands.add_parser('replay', help='replay a recorded session with a stand-in camera')
+    parser_replay.add_argument('session', help='recorded file (JSON lines)')
+    parser_replay.add_argument('--speed', type=float, default=1, help='replay speed factor, 0 for no delays')
+    parser_replay.add_argument('--size', default='1920x1080', help='preview size WxH')
+    parser_replay.add_argument('--format', choices=['BGR888', 'YUV420'], default='BGR888')
+    parser_replay.add_argument('--fps', type=float, default=30, help='frame rate of the stand-in camera')
+    parser_replay.add_argument('--af-ms', type=float, default=300, help='duration of an autofocus cycle')
+    parser_replay.add_argument('--telemetry', action='store_true', help='enable and print the telemetry of magni')
+    parser_replay.add_argument('--verbose', action='store_true', help='print latencies of every event')
+    parser_replay.set_defaults(run=replay)
+
+    args = parser.parse_args()
+    args.run(args)
+
+if __name__ == '__main__':
+    main()